@@ -10,5 +10,6 @@ long_description=open("readme.md", "r").read(),
 description="Cross platform Auto updater for python desktop apps",
 package_data={"updater": ["bootstrappers/**/*"]},
 zip_safe = False,
+entry_points={"console_scripts": ["updater-build=updater.builder:main", "updater-rollback=updater.rollback:main", "updater-peercache=updater.peercache:main", "updater-cli=updater.cliupdater:main"]},
 install_requires=["pypubsub", "PySocks", "win_inet_pton"]
 )
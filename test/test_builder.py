@@ -0,0 +1,79 @@
+import os
+import json
+import hashlib
+import zipfile
+import pytest
+from unittest import mock
+from updater import builder, utils
+
+@pytest.fixture
+def build_directory(tmp_path):
+    source = tmp_path / "dist"
+    (source / "lib" / "data").mkdir(parents=True)
+    (source / "empty").mkdir()
+    (source / "bootstrap-lin.sh").write_bytes(b"#!/bin/bash\n")
+    (source / "app.py").write_bytes(b"print('hello world')\n"*1000)
+    (source / "lib" / "module.pyd").write_bytes(os.urandom(200000))
+    (source / "lib" / "data" / "empty.txt").write_bytes(b"")
+    yield source
+
+def test_build_update(build_directory, tmp_path):
+    archive_path = str(tmp_path / "update.zip")
+    file_hashes = builder.build_update(str(build_directory), archive_path, jobs=2)
+    assert sorted(file_hashes.keys()) == ["app.py", "bootstrap-lin.sh", "lib/data/empty.txt", "lib/module.pyd"]
+    for name, file_hash in file_hashes.items():
+        assert file_hash == hashlib.sha256((build_directory / name).read_bytes()).hexdigest()
+    with zipfile.ZipFile(archive_path) as archive:
+        assert archive.testzip() == None
+        assert "empty/" in archive.namelist()
+        for name in file_hashes:
+            assert archive.read(name) == (build_directory / name).read_bytes()
+            assert archive.getinfo(name).compress_type == zipfile.ZIP_DEFLATED
+    # Temporary files for compressed data must be removed.
+    assert sorted(os.listdir(str(tmp_path))) == ["dist", "update.zip"]
+
+def test_build_update_warns_without_bootstrapper(build_directory, tmp_path):
+    (build_directory / "bootstrap-lin.sh").unlink()
+    with mock.patch.object(builder.log, "warning") as log_warning:
+        builder.build_update(str(build_directory), str(tmp_path / "update.zip"), jobs=1)
+        log_warning.assert_called_once()
+
+def test_create_update_information(tmp_path):
+    archive_path = tmp_path / "update.zip"
+    archive_path.write_bytes(b"zip data")
+    archive_hash = hashlib.sha256(b"zip data").hexdigest()
+    result = builder.create_update_information("1.1", "Bug fixes.", "Linux64", "https://example.com/linux.zip", str(archive_path), 1024)
+    assert result == dict(current_version="1.1", description="Bug fixes.", downloads=dict(Linux64="https://example.com/linux.zip"), sha256=dict(Linux64=archive_hash), size=dict(Linux64=8), extracted_size=dict(Linux64=1024))
+    with_files = builder.create_update_information("1.1", "Bug fixes.", "Linux64", "https://example.com/linux.zip", str(archive_path), 1024, files_url="https://example.com/linux.files.json")
+    assert with_files["files"] == dict(Linux64="https://example.com/linux.files.json")
+    # Builds for other platforms are kept for the same version.
+    merged = builder.create_update_information("1.1", "Bug fixes.", "Windows64", "https://example.com/windows.zip", str(archive_path), 2048, result)
+    assert merged["downloads"] == dict(Linux64="https://example.com/linux.zip", Windows64="https://example.com/windows.zip")
+    assert merged["extracted_size"] == dict(Linux64=1024, Windows64=2048)
+    assert result["downloads"] == dict(Linux64="https://example.com/linux.zip")
+    # But not for a different version.
+    replaced = builder.create_update_information("1.2", "New version.", "Windows64", "https://example.com/windows.zip", str(archive_path), 2048, merged)
+    assert replaced["downloads"] == dict(Windows64="https://example.com/windows.zip")
+
+def test_main(build_directory, tmp_path):
+    output = tmp_path / "public"
+    arguments = [str(build_directory), "--version", "1.1", "--description", "Bug fixes.", "--base-url", "https://example.com/updates/", "--platform", "Linux64", "--output-dir", str(output), "--jobs", "2"]
+    assert builder.main(arguments) == 0
+    with open(str(output / "update.json")) as f:
+        update_information = json.load(f)
+    assert update_information["current_version"] == "1.1"
+    assert update_information["description"] == "Bug fixes."
+    assert update_information["downloads"] == dict(Linux64="https://example.com/updates/update-1.1-Linux64.zip")
+    assert update_information["sha256"]["Linux64"] == utils.hash_file(str(output / "update-1.1-Linux64.zip"))
+    assert update_information["extracted_size"]["Linux64"] == 200000+21000+12
+    assert update_information["files"] == dict(Linux64="https://example.com/updates/update-1.1-Linux64.files.json")
+    with open(str(output / "update-1.1-Linux64.files.json")) as f:
+        assert sorted(json.load(f).keys()) == ["app.py", "bootstrap-lin.sh", "lib/data/empty.txt", "lib/module.pyd"]
+    # A second build for another platform is added to the same update file.
+    arguments[arguments.index("Linux64")] = "Windows64"
+    assert builder.main(arguments) == 0
+    with open(str(output / "update.json")) as f:
+        assert sorted(json.load(f)["downloads"].keys()) == ["Linux64", "Windows64"]
+
+def test_main_invalid_directory(tmp_path):
+    assert builder.main([str(tmp_path / "missing"), "--version", "1.1", "--base-url", "https://example.com"]) == 1
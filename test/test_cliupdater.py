@@ -0,0 +1,179 @@
+import io
+import json
+import pytest
+from unittest import mock
+from updater import cliupdater, utils
+
+app_name: str = "a simple app"
+current_version: str = "0.15"
+endpoint: str = "https://gitlab.mcvsoftware.com"
+update_path = [dict(to="0.16", url="https://example.com/update.zip")]
+
+def create_updater(**kwargs):
+    global app_name, current_version, endpoint
+    return cliupdater.CLIUpdater(endpoint=endpoint, app_name=app_name, current_version=current_version, output=io.StringIO(), app_path="app", **kwargs)
+
+def json_events(updater):
+    return [json.loads(line) for line in updater.output.getvalue().splitlines()]
+
+@pytest.fixture
+def update_available():
+    """ Patches the update check of CLIUpdater, so an update from 0.15 to 0.16 is available. """
+    with mock.patch.object(cliupdater.CLIUpdater, "get_update_information"):
+        with mock.patch.object(cliupdater.CLIUpdater, "get_version_data", return_value=("0.16", "Bug fixes.", "https://example.com/update.zip")):
+            with mock.patch.object(cliupdater.CLIUpdater, "get_update_path", return_value=update_path):
+                yield
+
+def test_invalid_progress():
+    with pytest.raises(ValueError):
+        create_updater(progress="xml")
+
+def test_check_for_updates_up_to_date():
+    updater = create_updater(progress="json")
+    with mock.patch.object(updater, "get_update_information"):
+        with mock.patch.object(updater, "get_version_data", return_value=(False, False, False)):
+            assert updater.check_for_updates() == cliupdater.EXIT_UP_TO_DATE
+    assert json_events(updater) == [dict(event="up-to-date", version="0.15")]
+
+def test_check_for_updates_not_accepted(update_available):
+    updater = create_updater(progress="json")
+    with mock.patch("sys.stdin") as stdin:
+        stdin.isatty.return_value = False
+        with mock.patch.object(updater, "stage_update") as stage_update:
+            assert updater.check_for_updates() == cliupdater.EXIT_UPDATE_AVAILABLE
+            stage_update.assert_not_called()
+    assert json_events(updater) == [dict(event="update-available", version="0.16", description="Bug fixes.")]
+
+@pytest.mark.parametrize("response, result", [("y", cliupdater.EXIT_UPDATE_STAGED), ("", cliupdater.EXIT_UPDATE_AVAILABLE)])
+def test_check_for_updates_asks_in_terminal(update_available, response, result):
+    updater = create_updater(download_only=True)
+    with mock.patch("sys.stdin") as stdin:
+        stdin.isatty.return_value = True
+        with mock.patch("builtins.input", return_value=response):
+            with mock.patch.object(updater, "stage_update", return_value="staged"):
+                assert updater.check_for_updates() == result
+
+def test_check_for_updates_download_only(update_available):
+    updater = create_updater(auto_accept=True, download_only=True, progress="json", max_rate=1024)
+    with mock.patch.object(updater, "stage_update", return_value="staged") as stage_update:
+        with mock.patch.object(updater, "install_update") as install_update:
+            assert updater.check_for_updates() == cliupdater.EXIT_UPDATE_STAGED
+            install_update.assert_not_called()
+        stage_update.assert_called_once_with(update_path, "0.16", max_rate=1024, reference_path="app")
+    assert json_events(updater)[-1] == dict(event="staged", version="0.16", path="staged")
+
+def test_check_for_updates_install(update_available):
+    updater = create_updater(auto_accept=True)
+    with mock.patch.object(updater, "stage_update", return_value="staged"):
+        with mock.patch.object(updater, "move_bootstrap", return_value="bootstrap") as move_bootstrap:
+            with mock.patch.object(updater, "execute_bootstrap") as execute_bootstrap:
+                assert updater.check_for_updates() == cliupdater.EXIT_UPDATE_INSTALLING
+                move_bootstrap.assert_called_once_with("staged")
+                execute_bootstrap.assert_called_once_with("bootstrap", "staged")
+    assert "Installing a simple app 0.16" in updater.output.getvalue()
+
+def test_check_for_updates_install_at_exit(update_available):
+    updater = create_updater(auto_accept=True, install_at_exit=True)
+    with mock.patch.object(updater, "stage_update", return_value="staged"):
+        with mock.patch.object(updater, "install_update") as install_update:
+            with mock.patch("atexit.register") as atexit_register:
+                assert updater.check_for_updates() == cliupdater.EXIT_UPDATE_INSTALLING
+                atexit_register.assert_called_once_with(updater.install_update, "staged")
+            install_update.assert_not_called()
+
+def test_check_for_updates_splay():
+    updater = create_updater(splay=60)
+    with mock.patch("random.uniform", return_value=12) as uniform:
+        with mock.patch("time.sleep") as sleep:
+            with mock.patch.object(updater, "get_update_information"):
+                with mock.patch.object(updater, "get_version_data", return_value=(False, False, False)):
+                    updater.check_for_updates()
+        uniform.assert_called_once_with(0, 60)
+        sleep.assert_called_once_with(12)
+
+def test_on_update_progress_json():
+    updater = create_updater(progress="json")
+    for downloaded in (0, 10, 20, 50, 100):
+        updater.on_update_progress(downloaded, 200)
+    # Reports are only written when the percentage changes.
+    assert [event["percentage"] for event in json_events(updater)] == [0, 5, 10, 25, 50]
+    updater.on_update_progress(200, 200)
+    assert json_events(updater)[-1] == dict(event="progress", downloaded=200, total=200, percentage=100)
+
+def test_on_update_progress_text():
+    updater = create_updater()
+    for downloaded in range(0, 1025, 64):
+        updater.on_update_progress(downloaded, 1024)
+    # Without a terminal, a line is written when progress goes up by 10%.
+    lines = updater.output.getvalue().splitlines()
+    assert [line.split()[1] for line in lines] == ["0%", "12%", "25%", "31%", "43%", "50%", "62%", "75%", "81%", "93%", "100%"]
+    assert lines[-1] == "Downloading... 100% ({0} of {0})".format(utils.convert_bytes(1024))
+
+def test_on_update_progress_uneven_chunks():
+    updater = create_updater()
+    # A 50 KB download received in chunks of 8 KB, so percentages jump.
+    for downloaded in list(range(0, 50000, 8192))+[50000]:
+        updater.on_update_progress(downloaded, 50000)
+    assert [line.split()[1] for line in updater.output.getvalue().splitlines()] == ["0%", "16%", "32%", "49%", "65%", "81%", "98%", "100%"]
+    # The next package of the update is reported from the start.
+    updater.on_update_progress(0, 50000)
+    assert updater.output.getvalue().splitlines()[-1].split()[1] == "0%"
+
+@pytest.mark.parametrize("progress", ["text", "json"])
+def test_on_update_progress_unknown_size(progress):
+    updater = create_updater(progress=progress)
+    updater.unknown_size_step = 64*1024
+    # Without Content-Length, total_size is -1. Five chunks of 8 KB mustn't produce five reports.
+    for downloaded in range(0, 256*1024+1, 8192):
+        updater.on_update_progress(downloaded, -1)
+    lines = updater.output.getvalue().splitlines()
+    assert len(lines) == 5
+    if progress == "json":
+        assert json.loads(lines[-1]) == dict(event="progress", downloaded=256*1024, total=None, percentage=None)
+    else:
+        assert lines[-1] == "Downloading... {}".format(utils.convert_bytes(256*1024))
+
+def test_on_update_progress_terminal():
+    updater = create_updater()
+    updater.output.isatty = lambda: True
+    for downloaded in (0, 512, 1024):
+        updater.on_update_progress(downloaded, 1024)
+    updater.on_update_progress(0, -1)
+    updater.report("staged", "Ready.")
+    size = utils.convert_bytes
+    expected = "\rDownloading... 0% ({} of {})".format(size(0), size(1024))
+    expected += "\rDownloading... 50% ({} of {})".format(size(512), size(1024))
+    expected += "\rDownloading... 100% ({} of {})\n".format(size(1024), size(1024))
+    # Progress without size is finished by the next report.
+    expected += "\rDownloading... {}\nReady.\n".format(size(0))
+    assert updater.output.getvalue() == expected
+
+def test_main(update_available, capsys):
+    with mock.patch.object(cliupdater.CLIUpdater, "stage_update", return_value="staged") as stage_update:
+        result = cliupdater.main(["--endpoint", "https://example.com/update.json", "--current-version", "0.15", "--app-path", "app", "--executable", "app/app", "--yes", "--download-only", "--progress", "json"])
+        assert result == cliupdater.EXIT_UPDATE_STAGED
+        stage_update.assert_called_once_with(update_path, "0.16", max_rate=None, reference_path="app")
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [event["event"] for event in events] == ["update-available", "staged"]
+
+def test_main_error(capsys):
+    with mock.patch.object(cliupdater.CLIUpdater, "get_update_information", side_effect=OSError("Network unreachable")):
+        result = cliupdater.main(["--endpoint", "https://example.com/update.json", "--current-version", "0.15", "--app-path", "app", "--executable", "app/app", "--progress", "json"])
+    assert result == cliupdater.EXIT_ERROR
+    assert json.loads(capsys.readouterr().out) == dict(event="error", error="Network unreachable")
+
+def test_main_peers_require_cache_directory():
+    assert cliupdater.main(["--endpoint", "https://example.com/update.json", "--current-version", "0.15", "--app-path", "app", "--executable", "app/app", "--peer", "http://192.168.1.10:8765"]) == cliupdater.EXIT_ERROR
+
+@pytest.mark.parametrize("missing", ["--app-path", "--executable"])
+def test_main_requires_application(missing, capsys):
+    arguments = ["--endpoint", "https://example.com/update.json", "--current-version", "0.15", "--app-path", "app", "--executable", "app/app", "--yes"]
+    index = arguments.index(missing)
+    del arguments[index:index+2]
+    # Otherwise, the directory of the updater-cli command itself would be updated.
+    with mock.patch.object(cliupdater.CLIUpdater, "check_for_updates") as check_for_updates:
+        with pytest.raises(SystemExit) as exit:
+            cliupdater.main(arguments)
+        check_for_updates.assert_not_called()
+    assert exit.value.code == 2
+    assert missing in capsys.readouterr().err
@@ -1,10 +1,17 @@
 import sys
 import os
+import errno
+import hashlib
+import socket
+import ssl
+import threading
+import time
+import zipfile
 import pytest
 from unittest import mock
 from json.decoder import JSONDecodeError
-from urllib.error import HTTPError
-from updater import core
+from urllib.error import HTTPError, URLError, ContentTooShortError
+from updater import core, paths, rollback
 
 app_name: str = "a simple app"
 current_version: str = "0.15"
@@ -19,29 +26,288 @@ sys.modules["win32api"] = win32api
 def test_get_update_information_valid_json(file_data, json_data):
     global app_name, current_version, endpoint
     updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
-    response = mock.Mock()
-    response.getcode.return_value = 200
-    response.read.return_value = file_data
-    with mock.patch("urllib.request.urlopen", return_value=response):
+    with mock.patch("urllib.request.urlopen", return_value=fake_response(file_data.encode())) as urlopen:
         contents = updater.get_update_information()
         assert contents == json_data
+        assert urlopen.call_args[1]["timeout"] == updater.connect_timeout
 
 def test_get_update_information_invalid_json(file_data, json_data):
     global app_name, current_version, endpoint
     updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
-    response = mock.Mock()
-    response.getcode.return_value = 200
-    response.read.return_value = "invalid json"
-    with mock.patch("urllib.request.urlopen", return_value=response):
+    with mock.patch("urllib.request.urlopen", return_value=fake_response(b"invalid json")) as urlopen:
         with pytest.raises(JSONDecodeError):
             contents = updater.get_update_information()
+        # Invalid responses are not retried.
+        urlopen.assert_called_once()
 
 def test_get_update_information_not_found():
     global app_name, current_version, endpoint
     updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
-    with mock.patch("urllib.request.urlopen", side_effect=HTTPError(updater.endpoint, 404, "not found", None, None)):
+    with mock.patch("urllib.request.urlopen", side_effect=HTTPError(updater.endpoint, 404, "not found", None, None)) as urlopen:
         with pytest.raises(HTTPError):
             contents = updater.get_update_information()
+        urlopen.assert_called_once()
+
+def test_get_update_information_cached(file_data, json_data, tmp_path):
+    global app_name, current_version, endpoint
+    state_file = str(tmp_path / "state.json")
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, check_interval=3600, state_file=state_file)
+    with mock.patch("urllib.request.urlopen", side_effect=lambda *args, **kwargs: fake_response(file_data.encode())) as urlopen:
+        assert updater.get_update_information() == json_data
+        assert updater.get_update_information() == json_data
+        urlopen.assert_called_once()
+        # A forced check always calls the endpoint.
+        assert updater.get_update_information(force=True) == json_data
+        assert urlopen.call_count == 2
+    # Cache is shared between instances.
+    other_updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, check_interval=3600, state_file=state_file)
+    with mock.patch("urllib.request.urlopen") as urlopen:
+        assert other_updater.get_update_information() == json_data
+        urlopen.assert_not_called()
+
+@pytest.mark.parametrize("changes", [
+    dict(current_version="0.16"),
+    dict(endpoint="https://example.com/other.json"),
+    dict(check_interval=0),
+])
+def test_get_update_information_cache_invalidated(file_data, tmp_path, changes):
+    global app_name, current_version, endpoint
+    state_file = str(tmp_path / "state.json")
+    params = dict(endpoint=endpoint, app_name=app_name, current_version=current_version, check_interval=3600, state_file=state_file)
+    updater = core.UpdaterCore(**params)
+    with mock.patch("urllib.request.urlopen", return_value=fake_response(file_data.encode())):
+        updater.get_update_information()
+    params.update(changes)
+    updater = core.UpdaterCore(**params)
+    with mock.patch("urllib.request.urlopen", return_value=fake_response(file_data.encode())) as urlopen:
+        updater.get_update_information()
+        urlopen.assert_called_once()
+
+def test_get_update_information_cache_expired(file_data, tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, check_interval=60, state_file=str(tmp_path / "state.json"))
+    with mock.patch("urllib.request.urlopen", side_effect=lambda *args, **kwargs: fake_response(file_data.encode())) as urlopen:
+        with mock.patch("time.time", return_value=1000):
+            updater.get_update_information()
+        with mock.patch("time.time", return_value=1030):
+            updater.get_update_information()
+        assert urlopen.call_count == 1
+        with mock.patch("time.time", return_value=1061):
+            updater.get_update_information()
+        assert urlopen.call_count == 2
+
+@pytest.mark.parametrize("error", [
+    URLError(ConnectionRefusedError(111, "Connection refused")),
+    socket.timeout("timed out"),
+    HTTPError(endpoint, 503, "Service unavailable", None, None),
+    HTTPError(endpoint, 429, "Too many requests", None, None),
+])
+def test_get_update_information_retries(file_data, json_data, error):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, retries=2, retry_backoff=1)
+    with mock.patch("urllib.request.urlopen", side_effect=[error, error, fake_response(file_data.encode())]) as urlopen:
+        with mock.patch("time.sleep") as time_sleep:
+            assert updater.get_update_information() == json_data
+    assert urlopen.call_count == 3
+    # Jittered exponential backoff.
+    delays = [c[0][0] for c in time_sleep.call_args_list]
+    assert 0 <= delays[0] <= 1
+    assert 0 <= delays[1] <= 2
+
+def test_get_update_information_retries_exhausted():
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, retries=1)
+    with mock.patch("urllib.request.urlopen", side_effect=URLError(ConnectionRefusedError(111, "Connection refused"))) as urlopen:
+        with mock.patch("time.sleep"):
+            with pytest.raises(URLError):
+                updater.get_update_information()
+    assert urlopen.call_count == 2
+
+def test_fetch_update_information_read_timeout():
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, connect_timeout=5, read_timeout=10)
+    with mock.patch("urllib.request.urlopen", return_value=fake_response(b"a"*4096)) as urlopen:
+        with mock.patch("time.monotonic", side_effect=[0, 5, 11]):
+            with pytest.raises(socket.timeout):
+                updater.fetch_update_information()
+        assert urlopen.call_args[1]["timeout"] == 5
+
+def test_request_update_information_hedged():
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, hedge=True)
+    release = threading.Event()
+    calls = []
+
+    def fetch(url):
+        calls.append(threading.current_thread())
+        if len(calls) == 1:
+            # First request stalls until the test finishes.
+            release.wait(5)
+            return b"slow"
+        return b"fast"
+
+    with mock.patch.object(updater, "get_hedge_delay", return_value=0.05):
+        with mock.patch.object(updater, "fetch_update_information", side_effect=fetch):
+            assert updater.request_update_information() == b"fast"
+    release.set()
+    assert len(calls) == 2
+
+def test_request_update_information_hedged_errors():
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, hedge=True)
+    # A fast response doesn't send a hedged request.
+    with mock.patch.object(updater, "fetch_update_information", return_value=b"data") as fetch:
+        assert updater.request_update_information() == b"data"
+        fetch.assert_called_once()
+    # Error is raised only when all requests fail.
+    def fetch(url):
+        time.sleep(0.05)
+        raise URLError("error")
+
+    with mock.patch.object(updater, "get_hedge_delay", return_value=0):
+        with mock.patch.object(updater, "fetch_update_information", side_effect=fetch) as fetch_update_information:
+            with pytest.raises(URLError):
+                updater.request_update_information()
+            assert fetch_update_information.call_count == 2
+
+def test_get_hedge_delay(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, hedge=True, state_file=str(tmp_path / "state.json"))
+    assert updater.get_hedge_delay() == 1.0
+    updater.get_response_times().extend([i/20 for i in range(1, 21)])
+    assert updater.get_hedge_delay() == 0.95
+    # Response times are persisted between runs.
+    with mock.patch.object(updater, "request_update_information", return_value=b"{}"):
+        updater.get_update_information()
+    other_updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, hedge=True, state_file=str(tmp_path / "state.json"))
+    assert other_updater.get_hedge_delay() == 0.95
+
+def test_is_transient_error():
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    assert updater.is_transient_error(ConnectionResetError()) == True
+    assert updater.is_transient_error(HTTPError(endpoint, 502, "Bad gateway", None, None)) == True
+    assert updater.is_transient_error(HTTPError(endpoint, 404, "Not found", None, None)) == False
+    assert updater.is_transient_error(ValueError()) == False
+    # Errors wrapped by URLError are checked by their reason.
+    assert updater.is_transient_error(URLError(socket.timeout("timed out"))) == True
+    assert updater.is_transient_error(URLError(ConnectionRefusedError(111, "Connection refused"))) == True
+    assert updater.is_transient_error(URLError(socket.gaierror(socket.EAI_AGAIN, "Temporary failure in name resolution"))) == True
+    assert updater.is_transient_error(URLError(socket.gaierror(socket.EAI_NONAME, "Name or service not known"))) == False
+    assert updater.is_transient_error(URLError(ssl.SSLCertVerificationError(1, "certificate verify failed"))) == False
+    assert updater.is_transient_error(URLError(ssl.SSLEOFError(8, "EOF occurred in violation of protocol"))) == True
+    assert updater.is_transient_error(URLError("unknown url type: htps")) == False
+    assert updater.is_transient_error(URLError(ValueError("Invalid URL"))) == False
+
+def test_load_state_invalid_file(tmp_path):
+    global app_name, current_version, endpoint
+    state_file = tmp_path / "state.json"
+    state_file.write_text("invalid json")
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, state_file=str(state_file))
+    assert updater.load_state() == {}
+    updater.save_state(dict(key="value"))
+    assert updater.load_state() == dict(key="value")
+
+def test_update_state_concurrent_writers(tmp_path):
+    global app_name, current_version, endpoint
+    # Every instance stands for another process using the same state file, like the application and the rollback watchdog.
+    updaters = [core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, state_file=str(tmp_path / "state.json")) for index in range(4)]
+    original_load_state = core.UpdaterCore.load_state
+
+    def slow_load_state(self):
+        state = original_load_state(self)
+        time.sleep(0.001)
+        return state
+
+    def increment(updater):
+        for index in range(20):
+            with updater.update_state() as state:
+                state["counter"] = state.get("counter", 0)+1
+
+    with mock.patch.object(core.UpdaterCore, "load_state", slow_load_state):
+        threads = [threading.Thread(target=increment, args=(updater,)) for updater in updaters]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert updaters[0].load_state()["counter"] == 80
+
+def test_update_state_is_reentrant(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, state_file=str(tmp_path / "state.json"))
+    with updater.lock_state():
+        with updater.update_state() as state:
+            state["key"] = "value"
+    assert updater.load_state() == dict(key="value")
+
+def test_data_directory_without_app_name():
+    global app_name, current_version, endpoint
+    assert core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version).data_directory == paths.data_path(app_name)
+    # Applications without a name mustn't share staged updates and snapshots.
+    first = core.UpdaterCore(endpoint="https://example.com/first.json", current_version=current_version)
+    second = core.UpdaterCore(endpoint="https://example.com/second.json", current_version=current_version)
+    assert first.data_directory != second.data_directory
+    assert first.data_directory == core.UpdaterCore(endpoint="https://example.com/first.json", current_version="1.0").data_directory
+
+catalog = {"channels": {
+    "stable": {"Linux64": "stable/linux64.json", "Windows64": {"current_version": "1.0", "description": "Stable version.", "downloads": {"Windows64": "https://example.com/1.0.zip"}}},
+    "beta": "beta.json",
+    "nightly": {"current_version": "2.0-dev", "description": "Nightly.", "downloads": {"Linux64": "https://example.com/nightly.zip"}},
+}}
+catalog_files = {
+    "https://example.com/updates/stable/linux64.json": {"current_version": "1.0", "description": "Stable version.", "downloads": {"Linux64": "https://example.com/1.0.zip"}},
+    "https://example.com/updates/beta.json": {"Linux64": "beta/linux64.json"},
+    "https://example.com/updates/beta/linux64.json": {"current_version": "1.1-beta", "description": "Beta version.", "downloads": {"Linux64": "https://example.com/1.1-beta.zip"}},
+}
+
+@pytest.mark.parametrize("channel, system, expected_version, expected_requests", [
+    ("stable", "Linux", "1.0", ["https://example.com/updates/stable/linux64.json"]),
+    ("stable", "Windows", "1.0", []),
+    ("beta", "Linux", "1.1-beta", ["https://example.com/updates/beta.json", "https://example.com/updates/beta/linux64.json"]),
+    ("nightly", "Linux", "2.0-dev", []),
+])
+def test_get_update_information_catalog(channel, system, expected_version, expected_requests):
+    global app_name, current_version
+    updater = core.UpdaterCore(endpoint="https://example.com/updates/catalog.json", app_name=app_name, current_version=current_version, channel=channel)
+    requests = []
+    def load_update_file(url):
+        requests.append(url)
+        if url == updater.endpoint:
+            return catalog
+        return catalog_files[url]
+
+    with mock.patch.object(updater, "load_update_file", side_effect=load_update_file):
+        with mock.patch("platform.system", return_value=system):
+            with mock.patch("platform.architecture", return_value=("64bit", "")):
+                content = updater.get_update_information()
+    assert content["current_version"] == expected_version
+    # Only the catalog index and the entries for the selected channel and platform are retrieved.
+    assert requests == [updater.endpoint]+expected_requests
+
+@pytest.mark.parametrize("channel, system", [("alpha", "Linux"), ("stable", "Darwin")])
+def test_get_catalog_entry_not_found(channel, system):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, channel=channel)
+    with mock.patch("platform.system", return_value=system):
+        with mock.patch("platform.architecture", return_value=("64bit", "")):
+            with pytest.raises(KeyError):
+                updater.get_catalog_entry(catalog)
+
+def test_version_data_catalog():
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, channel="nightly")
+    with mock.patch("platform.system", return_value="Linux"):
+        with mock.patch("platform.architecture", return_value=("64bit", "")):
+            assert updater.get_version_data(catalog) == ("2.0-dev", "Nightly.", "https://example.com/nightly.zip")
+            assert [package["url"] for package in updater.get_update_path(catalog)] == ["https://example.com/nightly.zip"]
+
+def test_get_update_information_cache_channel(file_data, tmp_path):
+    global app_name, current_version, endpoint
+    params = dict(endpoint=endpoint, app_name=app_name, current_version=current_version, check_interval=3600, state_file=str(tmp_path / "state.json"))
+    with mock.patch("urllib.request.urlopen", side_effect=lambda *args, **kwargs: fake_response(file_data.encode())) as urlopen:
+        core.UpdaterCore(**params).get_update_information()
+        core.UpdaterCore(channel="beta", **params).get_update_information()
+        assert urlopen.call_count == 2
 
 def test_version_data_no_update(json_data):
     global app_name, endpoint
@@ -70,18 +336,292 @@ def test_version_data_architecture_not_found(json_data):
             with pytest.raises(KeyError):
                 results = updater.get_version_data(json_data)
 
-def fake_download_function(url, destination, callback):
-    callback(0, 1024, 2048)
-    return ("file", "headers")
+def fake_response(data, status=200, headers=None):
+    # Builds a fake response for urlopen, that returns data in chunks of 1024 bytes.
+    response = mock.MagicMock()
+    response.__enter__.return_value = response
+    response.status = status
+    response.headers = headers if headers != None else {"Content-Length": str(len(data))}
+    response.read.side_effect = [data[i:i+1024] for i in range(0, len(data), 1024)]+[b""]
+    return response
 
-def test_download_update():
+def test_download_update(tmp_path):
     global app_name, current_version, endpoint
     updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    destination = str(tmp_path / "update.zip")
     with mock.patch("pubsub.pub.sendMessage") as pub_sendMessage:
-        with mock.patch("urllib.request.urlretrieve", side_effect=fake_download_function):
-            result = updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination="update.zip")
-            assert result == "update.zip"
-            pub_sendMessage.assert_called_once()
+        with mock.patch("urllib.request.urlopen", return_value=fake_response(b"a"*1024)):
+            result = updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination=destination)
+            assert result == destination
+            pub_sendMessage.assert_called_once_with("updater.update-progress", total_downloaded=1024, total_size=1024)
+
+@pytest.mark.parametrize("status, expected_content", [
+    # Server honors the range request, so only the remaining bytes are appended.
+    (206, b"a"*1024+b"b"*1024),
+    # Server ignores the range request, so the file is downloaded again.
+    (200, b"b"*1024),
+])
+def test_download_update_resume(tmp_path, status, expected_content):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    destination = tmp_path / "update.zip"
+    destination.write_bytes(b"a"*1024)
+    with mock.patch("pubsub.pub.sendMessage") as pub_sendMessage:
+        with mock.patch("urllib.request.urlopen", return_value=fake_response(b"b"*1024, status=status)) as urlopen:
+            updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination=str(destination), resume=True)
+    assert urlopen.call_args[0][0].get_header("Range") == "bytes=1024-"
+    assert destination.read_bytes() == expected_content
+    pub_sendMessage.assert_called_once_with("updater.update-progress", total_downloaded=len(expected_content), total_size=len(expected_content))
+
+def test_download_update_resume_completed(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    destination = tmp_path / "update.zip"
+    destination.write_bytes(b"a"*1024)
+    with mock.patch("urllib.request.urlopen", side_effect=HTTPError("http://downloads.update.org/update.zip", 416, "Range not satisfiable", None, None)):
+        result = updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination=str(destination), resume=True)
+    assert result == str(destination)
+    assert destination.read_bytes() == b"a"*1024
+
+def test_download_update_throttled(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    with mock.patch("pubsub.pub.sendMessage"):
+        with mock.patch("urllib.request.urlopen", return_value=fake_response(b"a"*4096)):
+            with mock.patch("time.monotonic", return_value=0):
+                with mock.patch("time.sleep") as time_sleep:
+                    updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination=str(tmp_path / "update.zip"), chunk_size=1024, max_rate=1024)
+    # With a rate of 1024 bytes per second and a frozen clock, every chunk must wait one more second.
+    assert [c[0][0] for c in time_sleep.call_args_list] == [1, 2, 3, 4]
+
+def test_download_update_path(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    update_path = [dict(url="https://example.com/0.15-0.16.zip"), dict(url="https://example.com/0.16-0.17.zip")]
+
+    def fake_download(update_url, update_destination, resume, max_rate, extracted_size, extraction_path):
+        with open(update_destination, "w") as f:
+            f.write(update_url)
+        return update_destination
+
+    extracted = []
+    def fake_extract(update_archive, destination, reference_path, file_hashes):
+        with open(update_archive) as f:
+            extracted.append(f.read())
+        return destination
+
+    with mock.patch.object(updater, "download_update", side_effect=fake_download) as download_update:
+        with mock.patch.object(updater, "extract_update", side_effect=fake_extract):
+            result = updater.download_update_path(update_path, str(tmp_path), resume=True, max_rate=1024)
+    assert result == str(tmp_path / "update")
+    assert extracted == ["https://example.com/0.15-0.16.zip", "https://example.com/0.16-0.17.zip"]
+    assert download_update.call_args[1] == dict(resume=True, max_rate=1024, extracted_size=None, extraction_path=str(tmp_path / "update"))
+    assert os.listdir(str(tmp_path)) == []
+
+def test_download_update_path_verifies_sha256(tmp_path):
+    global app_name, current_version, endpoint
+    peer_cache = mock.Mock()
+    peer_cache.fetch.return_value = False
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, peer_cache=peer_cache)
+    update_path = [dict(url="https://example.com/update.zip", sha256=hashlib.sha256(b"https://example.com/update.zip").hexdigest())]
+
+    def fake_download(update_url, update_destination, resume, max_rate, extracted_size, extraction_path):
+        with open(update_destination, "w") as f:
+            f.write(update_url)
+        return update_destination
+
+    with mock.patch.object(updater, "download_update", side_effect=fake_download):
+        with mock.patch.object(updater, "extract_update", return_value=str(tmp_path / "update")):
+            updater.download_update_path(update_path, str(tmp_path))
+    peer_cache.fetch.assert_called_once_with(update_path[0]["sha256"], str(tmp_path / "update-0.zip"), size=None)
+    peer_cache.add.assert_called_once_with(str(tmp_path / "update-0.zip"), update_path[0]["sha256"])
+    # Corrupted downloads are removed and never shared with peers.
+    peer_cache.reset_mock()
+    update_path[0]["sha256"] = "0"*64
+    with mock.patch.object(updater, "download_update", side_effect=fake_download):
+        with pytest.raises(ValueError):
+            updater.download_update_path(update_path, str(tmp_path))
+    peer_cache.add.assert_not_called()
+    assert not os.path.exists(str(tmp_path / "update-0.zip"))
+
+def test_download_update_path_from_peer_checks_free_space(tmp_path):
+    global app_name, current_version, endpoint
+    peer_cache = mock.Mock()
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, peer_cache=peer_cache)
+    update_path = [dict(url="https://example.com/update.zip", sha256="a"*64, size=2048, extracted_size=4096)]
+    with mock.patch("shutil.disk_usage", return_value=mock.Mock(free=4096)):
+        with pytest.raises(OSError) as error:
+            updater.download_update_path(update_path, str(tmp_path))
+    assert error.value.errno == errno.ENOSPC
+    peer_cache.fetch.assert_not_called()
+    with mock.patch.object(updater, "extract_update", return_value=str(tmp_path / "update")):
+        with mock.patch("os.remove"):
+            updater.download_update_path(update_path, str(tmp_path))
+    # Peers can't send more data than the update file reports.
+    peer_cache.fetch.assert_called_once_with("a"*64, str(tmp_path / "update-0.zip"), size=2048)
+
+def test_download_update_path_peer_cache_failure(tmp_path):
+    global app_name, current_version, endpoint
+    peer_cache = mock.Mock()
+    peer_cache.fetch.return_value = False
+    peer_cache.add.side_effect = OSError(errno.ENOSPC, "No space left on device")
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, peer_cache=peer_cache)
+    update_path = [dict(url="https://example.com/update.zip", sha256=hashlib.sha256(b"update").hexdigest())]
+
+    def fake_download(update_url, update_destination, resume, max_rate, extracted_size, extraction_path):
+        with open(update_destination, "wb") as f:
+            f.write(b"update")
+        return update_destination
+
+    # A verified update is installed even if it can't be shared with peers.
+    with mock.patch.object(updater, "download_update", side_effect=fake_download):
+        with mock.patch.object(updater, "extract_update", return_value=str(tmp_path / "update")) as extract_update:
+            assert updater.download_update_path(update_path, str(tmp_path)) == str(tmp_path / "update")
+            extract_update.assert_called_once()
+    peer_cache.add.assert_called_once()
+
+def test_download_update_path_from_peer(tmp_path):
+    global app_name, current_version, endpoint
+    peer_cache = mock.Mock()
+    peer_cache.fetch.return_value = True
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, peer_cache=peer_cache)
+    update_path = [dict(url="https://example.com/update.zip", sha256="a"*64)]
+    with mock.patch.object(updater, "download_update") as download_update:
+        with mock.patch.object(updater, "extract_update", return_value=str(tmp_path / "update")) as extract_update:
+            with mock.patch("os.remove"):
+                updater.download_update_path(update_path, str(tmp_path))
+            download_update.assert_not_called()
+            extract_update.assert_called_once_with(str(tmp_path / "update-0.zip"), destination=str(tmp_path / "update"), reference_path=None, file_hashes=None)
+
+def test_download_update_not_enough_space(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    destination = tmp_path / "update.zip"
+    disk_usage = mock.Mock(free=4096)
+    with mock.patch("shutil.disk_usage", return_value=disk_usage):
+        with mock.patch("urllib.request.urlopen", return_value=fake_response(b"a"*2048)) as urlopen:
+            with pytest.raises(OSError) as error:
+                updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination=str(destination), extracted_size=4096, extraction_path=str(tmp_path / "update"))
+            assert error.value.errno == errno.ENOSPC
+            urlopen.return_value.read.assert_not_called()
+    assert not destination.exists()
+    # Space is enough for the download alone.
+    with mock.patch("shutil.disk_usage", return_value=disk_usage):
+        with mock.patch("pubsub.pub.sendMessage"):
+            with mock.patch("urllib.request.urlopen", return_value=fake_response(b"a"*2048)):
+                updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination=str(destination))
+    assert destination.read_bytes() == b"a"*2048
+
+def test_check_free_space(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    free_space = mock.Mock(free=1000)
+    with mock.patch("shutil.disk_usage", return_value=free_space) as disk_usage:
+        updater.check_free_space({str(tmp_path / "missing" / "update.zip"): 500})
+        disk_usage.assert_called_once_with(str(tmp_path))
+        # Requirements in the same volume are added together.
+        with pytest.raises(OSError):
+            updater.check_free_space({str(tmp_path / "update.zip"): 500, str(tmp_path / "update"): 501})
+
+def test_download_update_preallocates_file(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    destination = str(tmp_path / "update.zip")
+    with mock.patch("pubsub.pub.sendMessage"):
+        with mock.patch("urllib.request.urlopen", return_value=fake_response(b"a"*2048)):
+            with mock.patch.object(updater, "preallocate_file") as preallocate_file:
+                updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination=destination)
+                assert preallocate_file.call_args[0][1] == 2048
+    assert not os.path.exists(destination+".progress")
+
+def test_preallocate_file(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    with open(str(tmp_path / "update.zip"), "wb") as f:
+        updater.preallocate_file(f, 4096)
+    assert os.path.getsize(str(tmp_path / "update.zip")) == 4096
+
+def test_download_update_interrupted_and_resumed(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    destination = tmp_path / "update.zip"
+    data = os.urandom(4096)
+    # Connection closed after the first half of the file.
+    interrupted = fake_response(data[:2048], headers={"Content-Length": "4096"})
+    with mock.patch("pubsub.pub.sendMessage"):
+        with mock.patch("urllib.request.urlopen", return_value=interrupted):
+            with pytest.raises(ContentTooShortError):
+                updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination=str(destination), resume=True)
+        # File was allocated with its full size, so the offset comes from the progress file.
+        assert (tmp_path / "update.zip.progress").read_text() == "2048"
+        with mock.patch("urllib.request.urlopen", return_value=fake_response(data[2048:], status=206)) as urlopen:
+            updater.download_update(update_url="http://downloads.update.org/update.zip", update_destination=str(destination), resume=True)
+            assert urlopen.call_args[0][0].get_header("Range") == "bytes=2048-"
+    assert destination.read_bytes() == data
+    assert not (tmp_path / "update.zip.progress").exists()
+
+def test_stage_update(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    updater.data_directory = str(tmp_path)
+    old_staging = tmp_path / "updates" / "0.14"
+    old_staging.mkdir(parents=True)
+    update_path = [dict(to="0.16", url="http://downloads.update.org/update.zip")]
+
+    def fake_download_update_path(update_path, base_path, resume, max_rate, reference_path):
+        assert resume == True
+        os.makedirs(os.path.join(base_path, "update"))
+        return os.path.join(base_path, "update")
+
+    with mock.patch.object(updater, "download_update_path", side_effect=fake_download_update_path) as download_update_path:
+        result = updater.stage_update(update_path, "0.16", max_rate=2048)
+        assert result == str(tmp_path / "updates" / "0.16" / "update")
+        assert download_update_path.call_args[1]["max_rate"] == 2048
+        assert not old_staging.exists()
+        # Staging the same update again should reuse it.
+        assert updater.stage_update(update_path, "0.16") == result
+        download_update_path.assert_called_once()
+        # Different packages for the same version must be staged again.
+        updater.stage_update([dict(to="0.16", url="http://downloads.update.org/other.zip")], "0.16")
+        assert download_update_path.call_count == 2
+
+def update_graph(packages, size=None):
+    content = dict(current_version="1.5", description="", downloads=dict(Linux64="https://example.com/1.5.zip"), packages=dict(Linux64=packages))
+    if size != None:
+        content["size"] = dict(Linux64=size)
+    return content
+
+@pytest.mark.parametrize("version, content, expected_urls", [
+    # No packages, so the full download is used.
+    ("1.2", update_graph([]), ["https://example.com/1.5.zip"]),
+    # Chain of deltas is smaller than the full package.
+    ("1.2", update_graph([dict({"from": "1.2"}, to="1.3", url="1.2-1.3", size=10), dict({"from": "1.3"}, to="1.5", url="1.3-1.5", size=10)], size=100), ["1.2-1.3", "1.3-1.5"]),
+    # The full package is smaller than the chain of deltas.
+    ("1.2", update_graph([dict({"from": "1.2"}, to="1.3", url="1.2-1.3", size=60), dict({"from": "1.3"}, to="1.5", url="1.3-1.5", size=60)], size=100), ["https://example.com/1.5.zip"]),
+    # Direct delta is preferred to a longer chain.
+    ("1.2", update_graph([dict({"from": "1.2"}, to="1.3", url="1.2-1.3", size=10), dict({"from": "1.3"}, to="1.5", url="1.3-1.5", size=10), dict({"from": "1.2"}, to="1.5", url="1.2-1.5", size=15)], size=100), ["1.2-1.5"]),
+    # Deltas from other versions are ignored.
+    ("1.1", update_graph([dict({"from": "1.2"}, to="1.3", url="1.2-1.3", size=10), dict({"from": "1.3"}, to="1.5", url="1.3-1.5", size=10)], size=100), ["https://example.com/1.5.zip"]),
+    # Full download without size is only used if there is no other choice.
+    ("1.2", update_graph([dict({"from": "1.2"}, to="1.5", url="1.2-1.5", size=1000)]), ["1.2-1.5"]),
+    # Full packages in the packages section can be combined with deltas.
+    ("1.0", update_graph([dict(to="1.3", url="1.3", size=50), dict({"from": "1.3"}, to="1.5", url="1.3-1.5", size=10)], size=100), ["1.3", "1.3-1.5"]),
+])
+def test_get_update_path(version, content, expected_urls):
+    global app_name, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=version)
+    with mock.patch("platform.system", return_value="Linux"):
+        with mock.patch("platform.architecture", return_value=("64bit", "")):
+            result = updater.get_update_path(content)
+    assert [package["url"] for package in result] == expected_urls
+
+def test_get_update_path_architecture_not_found(json_data):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    with mock.patch("platform.system", return_value="nonos"):
+        with mock.patch("platform.architecture", return_value=("31bits", "")):
+            with pytest.raises(KeyError):
+                updater.get_update_path(json_data)
 
 def test_extract_archive():
     # This only tests if archive extraction methods were called successfully and with the right parameters.
@@ -104,6 +644,83 @@ def test_extract_archive():
         zipfile_opened_with_password.setpassword.assert_called_once_with("MyLongPassword")
         zipfile_opened_with_password.extractall.assert_called_once()
 
+def test_extract_update_unchanged_files(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    installed = tmp_path / "app"
+    (installed / "lib").mkdir(parents=True)
+    (installed / "app.exe").write_bytes(b"old executable")
+    (installed / "lib" / "library.dll").write_bytes(b"library")
+    (installed / "data.txt").write_bytes(b"same size")
+    (installed / updater.bootstrap_name()).write_bytes(b"bootstrap")
+    archive_path = str(tmp_path / "update.zip")
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        archive.writestr("app.exe", b"new executable")
+        archive.writestr("lib/library.dll", b"library")
+        archive.writestr("data.txt", b"SAME SIZE")
+        archive.writestr("new.txt", b"new file")
+        archive.writestr("../outside.txt", b"library")
+        archive.writestr(updater.bootstrap_name(), b"bootstrap")
+    destination = tmp_path / "update"
+    # A file extracted by a previous package, which is reverted by this one.
+    (destination / "lib").mkdir(parents=True)
+    (destination / "lib" / "library.dll").write_bytes(b"changed library")
+    result = updater.extract_update(archive_path, str(destination), reference_path=str(installed))
+    assert result == str(destination)
+    assert (destination / "app.exe").read_bytes() == b"new executable"
+    assert (destination / "data.txt").read_bytes() == b"SAME SIZE"
+    assert (destination / "new.txt").read_bytes() == b"new file"
+    assert (destination / updater.bootstrap_name()).read_bytes() == b"bootstrap"
+    assert not (destination / "lib" / "library.dll").exists()
+    assert not (tmp_path / "outside.txt").exists()
+
+def test_extract_update_compares_sha256(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    installed = tmp_path / "app"
+    installed.mkdir()
+    # Two different files of the same size. Their CRC32 checksums are made to collide below.
+    (installed / "data.bin").write_bytes(b"\x00"*4)
+    collision = bytes(byte ^ 0xff for byte in b"\x00"*4)
+    archive_path = str(tmp_path / "update.zip")
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        archive.writestr("data.bin", collision)
+    with zipfile.ZipFile(archive_path) as archive:
+        crc = archive.getinfo("data.bin").CRC
+    with mock.patch("updater.core.zlib") as core_zlib:
+        core_zlib.crc32.return_value = crc
+        destination = tmp_path / "crc32"
+        updater.extract_update(archive_path, str(destination), reference_path=str(installed))
+        # Without hashes, only the CRC32 checksum is compared.
+        assert not (destination / "data.bin").exists()
+        destination = tmp_path / "sha256"
+        updater.extract_update(archive_path, str(destination), reference_path=str(installed), file_hashes={"data.bin": hashlib.sha256(collision).hexdigest()})
+        assert (destination / "data.bin").read_bytes() == collision
+    # Identical files are still skipped.
+    destination = tmp_path / "identical"
+    (installed / "data.bin").write_bytes(collision)
+    updater.extract_update(archive_path, str(destination), reference_path=str(installed), file_hashes={"data.bin": hashlib.sha256(collision).hexdigest()})
+    assert not (destination / "data.bin").exists()
+
+def test_download_update_path_file_hashes(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    update_path = [dict(url="https://example.com/1.zip", files="https://example.com/1.files.json"), dict(url="https://example.com/2.zip", files="https://example.com/2.files.json"), dict(url="https://example.com/3.zip")]
+    file_hashes = {"app.exe": "0"*64}
+
+    def fake_load_update_file(url):
+        if url == "https://example.com/2.files.json":
+            raise URLError("Not reachable")
+        return file_hashes
+
+    with mock.patch.object(updater, "download_update", side_effect=lambda url, destination, **kwargs: destination):
+        with mock.patch.object(updater, "load_update_file", side_effect=fake_load_update_file):
+            with mock.patch.object(updater, "extract_update", return_value=str(tmp_path / "update")) as extract_update:
+                with mock.patch("os.remove"):
+                    updater.download_update_path(update_path, str(tmp_path), reference_path="app")
+    # File hashes are optional, so packages whose hashes can't be retrieved fall back to CRC32.
+    assert [call[1]["file_hashes"] for call in extract_update.call_args_list] == [file_hashes, None, None]
+
 @pytest.mark.parametrize("system", [("Windows"), ("Darwin"), ("Linux")])
 def test_move_bootstrap(system):
     global app_name, current_version, endpoint
@@ -113,11 +730,31 @@ def test_move_bootstrap(system):
     # supposedly, the bootstrap file should be moved to the parent path.
 
     with mock.patch("platform.system", return_value=system):
-            with mock.patch("os.rename") as os_rename:
+            with mock.patch("os.replace") as os_replace:
                 expected_path = os.path.abspath(os.path.join(extracted_path, "..", updater.bootstrap_name()))
                 result = updater.move_bootstrap(extracted_path)
                 assert result == expected_path
-                os_rename.assert_called_once()
+                os_replace.assert_called_once()
+
+def test_move_bootstrap_staged_update_twice(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    updater.data_directory = str(tmp_path)
+    update_path = [dict(to="0.16", url="http://downloads.update.org/update.zip")]
+
+    def fake_download_update_path(update_path, base_path, resume, max_rate, reference_path):
+        os.makedirs(os.path.join(base_path, "update"))
+        with open(os.path.join(base_path, "update", updater.bootstrap_name()), "wb") as f:
+            f.write(b"bootstrap")
+        return os.path.join(base_path, "update")
+
+    with mock.patch.object(updater, "download_update_path", side_effect=fake_download_update_path) as download_update_path:
+        bootstrap_path = updater.move_bootstrap(updater.stage_update(update_path, "0.16"))
+        # The installation failed or was cancelled, so the same staged update is installed again.
+        assert updater.move_bootstrap(updater.stage_update(update_path, "0.16")) == bootstrap_path
+        download_update_path.assert_called_once()
+    with open(bootstrap_path, "rb") as f:
+        assert f.read() == b"bootstrap"
 
 @pytest.mark.parametrize("system", [("Windows"), ("Darwin"), ("Linux")])
 def test_execute_bootstrap(system):
@@ -138,6 +775,201 @@ def test_execute_bootstrap(system):
                             os_stat.assert_called_once()
                             subprocess_popen.assert_called_once()
 
+@pytest.fixture
+def installed_app(tmp_path):
+    app = tmp_path / "app"
+    (app / "lib").mkdir(parents=True)
+    (app / "app.exe").write_bytes(b"version 0.15")
+    (app / "lib" / "library.dll").write_bytes(b"library")
+    (app / "lib" / "changed.dll").write_bytes(b"old library")
+    update = tmp_path / "update"
+    (update / "lib").mkdir(parents=True)
+    (update / "app.exe").write_bytes(b"version 0.16")
+    (update / "lib" / "changed.dll").write_bytes(b"new library")
+    with mock.patch("updater.paths.app_path", return_value=str(app)):
+        with mock.patch("updater.paths.get_executable", return_value=str(app / "app.exe")):
+            with mock.patch("updater.paths.is_frozen", return_value=True):
+                yield app, update
+
+def install(source, destination):
+    # Does the same as the bootstrappers: copies the update over the application.
+    for root, directories, files in os.walk(source):
+        for name in files:
+            target = os.path.join(destination, os.path.relpath(os.path.join(root, name), source))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(os.path.join(root, name), "rb") as f, open(target, "wb") as t:
+                t.write(f.read())
+
+def test_create_snapshot_and_rollback(installed_app, tmp_path):
+    global app_name, current_version, endpoint
+    app, update = installed_app
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, state_file=str(tmp_path / "state.json"), snapshot_retention=1)
+    updater.snapshot_directory = str(tmp_path / "snapshots")
+    updater.update_version = "0.16"
+    snapshot = updater.create_snapshot(str(update))
+    assert snapshot == str(tmp_path / "snapshots" / "0.15")
+    # Unchanged files are linked, files replaced by the update are moved.
+    assert os.stat(os.path.join(snapshot, "lib", "library.dll")).st_ino == (app / "lib" / "library.dll").stat().st_ino
+    assert not (app / "app.exe").exists()
+    assert open(os.path.join(snapshot, "lib", "changed.dll"), "rb").read() == b"old library"
+    install(str(update), str(app))
+    # Installing the update doesn't alter the snapshot.
+    assert open(os.path.join(snapshot, "app.exe"), "rb").read() == b"version 0.15"
+    assert updater.load_state()["install"]["command"] == [str(app / "app.exe")]
+    with mock.patch("subprocess.Popen") as subprocess_popen:
+        assert updater.rollback() == True
+        subprocess_popen.assert_called_once_with([str(app / "app.exe")], cwd=str(app))
+    assert (app / "app.exe").read_bytes() == b"version 0.15"
+    assert (app / "lib" / "changed.dll").read_bytes() == b"old library"
+    assert (app / "lib" / "library.dll").read_bytes() == b"library"
+    assert os.listdir(str(tmp_path / "snapshots")) == []
+    assert "install" not in updater.load_state()
+    # Nothing else to roll back.
+    assert updater.rollback() == False
+
+def test_rollback_several_versions(installed_app, tmp_path):
+    global app_name, endpoint
+    app, update = installed_app
+    state_file = str(tmp_path / "state.json")
+    # Updates from 0.15 to 0.16 and from 0.16 to 0.17, keeping both snapshots.
+    for version, next_version in (("0.15", "0.16"), ("0.16", "0.17")):
+        updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=version, state_file=state_file, snapshot_retention=2)
+        updater.snapshot_directory = str(tmp_path / "snapshots")
+        updater.update_version = next_version
+        (update / "app.exe").write_bytes("version {}".format(next_version).encode())
+        updater.create_snapshot(str(update))
+        install(str(update), str(app))
+    assert [snapshot["version"] for snapshot in updater.get_snapshots()] == ["0.15", "0.16"]
+    with mock.patch("subprocess.Popen"):
+        assert updater.rollback() == True
+        assert (app / "app.exe").read_bytes() == b"version 0.16"
+        assert updater.rollback() == True
+        assert (app / "app.exe").read_bytes() == b"version 0.15"
+        assert (app / "lib" / "changed.dll").read_bytes() == b"old library"
+        assert updater.rollback() == False
+    assert os.listdir(str(tmp_path / "snapshots")) == []
+
+def test_rollback_version(installed_app, tmp_path):
+    global app_name, endpoint
+    app, update = installed_app
+    state_file = str(tmp_path / "state.json")
+    for version, next_version in (("0.15", "0.16"), ("0.16", "0.17")):
+        updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=version, state_file=state_file, snapshot_retention=2)
+        updater.snapshot_directory = str(tmp_path / "snapshots")
+        updater.update_version = next_version
+        (update / "app.exe").write_bytes("version {}".format(next_version).encode())
+        updater.create_snapshot(str(update))
+        install(str(update), str(app))
+    assert updater.rollback(relaunch=False, version="0.14") == False
+    assert updater.rollback(relaunch=False, version="0.15") == True
+    assert (app / "app.exe").read_bytes() == b"version 0.15"
+    assert [snapshot["version"] for snapshot in updater.get_snapshots()] == ["0.16"]
+
+def test_create_snapshot_retention(installed_app, tmp_path):
+    global app_name, endpoint
+    app, update = installed_app
+    for index, version in enumerate(["0.13", "0.14", "0.15"]):
+        updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=version, state_file=str(tmp_path / "state.json"), snapshot_retention=2)
+        updater.snapshot_directory = str(tmp_path / "snapshots")
+        snapshot = updater.create_snapshot(str(tmp_path / "empty"))
+        os.utime(snapshot, (index, index))
+    assert sorted(os.listdir(str(tmp_path / "snapshots"))) == ["0.14", "0.15"]
+
+def test_execute_bootstrap_with_snapshots(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, snapshot_retention=1, health_timeout=60)
+    with mock.patch("platform.system", return_value="Linux"):
+        with mock.patch.object(updater, "create_snapshot") as create_snapshot:
+            with mock.patch.object(updater, "start_watchdog") as start_watchdog:
+                with mock.patch.object(updater, "make_executable"):
+                    with mock.patch("subprocess.Popen"):
+                        updater.execute_bootstrap("bootstrap-lin.sh", "update")
+                        create_snapshot.assert_called_once_with("update")
+                        start_watchdog.assert_called_once()
+
+def test_execute_bootstrap_failure_restores_snapshot(installed_app, tmp_path):
+    global app_name, current_version, endpoint
+    app, update = installed_app
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, state_file=str(tmp_path / "state.json"), snapshot_retention=1, health_timeout=60)
+    updater.snapshot_directory = str(tmp_path / "snapshots")
+    updater.update_version = "0.16"
+    with mock.patch("platform.system", return_value="Windows"):
+        # As when the user declines the UAC prompt.
+        with mock.patch("win32api.ShellExecute", side_effect=Exception("The operation was canceled by the user.")):
+            with mock.patch.object(updater, "start_watchdog") as start_watchdog:
+                with mock.patch("subprocess.Popen") as subprocess_popen:
+                    with pytest.raises(Exception):
+                        updater.execute_bootstrap("bootstrap.exe", str(update))
+                    subprocess_popen.assert_not_called()
+                start_watchdog.assert_not_called()
+    assert (app / "app.exe").read_bytes() == b"version 0.15"
+    assert (app / "lib" / "changed.dll").read_bytes() == b"old library"
+    assert (app / "lib" / "library.dll").read_bytes() == b"library"
+    assert "install" not in updater.load_state()
+
+@pytest.mark.parametrize("is_frozen", [True, False])
+def test_start_watchdog(is_frozen):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, snapshot_retention=1, health_timeout=60)
+    with mock.patch("updater.paths.is_frozen", return_value=is_frozen):
+        with mock.patch("subprocess.Popen") as subprocess_popen:
+            updater.start_watchdog()
+            if is_frozen:
+                subprocess_popen.assert_not_called()
+            else:
+                assert subprocess_popen.call_args[0][0] == [sys.executable, "-m", "updater.rollback", "--state-file", os.path.abspath(updater.state_file), "watch"]
+                assert subprocess_popen.call_args[1]["cwd"] == os.path.dirname(os.path.dirname(os.path.abspath(core.__file__)))
+
+@pytest.mark.parametrize("handled", [True, False])
+def test_start_watchdog_frozen(tmp_path, handled):
+    global app_name, current_version, endpoint
+    app = tmp_path / "app"
+    snapshot = tmp_path / "snapshots" / "0.15"
+    snapshot.mkdir(parents=True)
+    (snapshot / "app.exe").write_bytes(b"version 0.15")
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, state_file=str(tmp_path / "state.json"), snapshot_retention=1, health_timeout=60)
+    updater.save_state(dict(install=dict(version="0.16", snapshot=str(snapshot), app_path=str(app), installed_at=1000, health_timeout=60, healthy=False)))
+    with mock.patch("updater.paths.is_frozen", return_value=True):
+        with mock.patch("sys.executable", str(app / "app.exe")):
+            with mock.patch("updater.rollback.watchdog_command_handled", handled):
+                with mock.patch("subprocess.Popen") as subprocess_popen:
+                    updater.start_watchdog()
+    if handled:
+        # The executable of the previous version runs the watchdog, as the installed one is replaced by the update.
+        assert subprocess_popen.call_args[0][0] == [str(snapshot / "app.exe"), rollback.watchdog_argument, "--state-file", os.path.abspath(updater.state_file), "watch"]
+    else:
+        # The application doesn't know the watchdog argument, so it would just start again.
+        subprocess_popen.assert_not_called()
+
+def test_start_watchdog_imports_bundled_package(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, state_file=str(tmp_path / "state.json"), snapshot_retention=1, health_timeout=60)
+    with mock.patch("updater.paths.is_frozen", return_value=False):
+        with mock.patch("subprocess.Popen") as subprocess_popen:
+            updater.start_watchdog()
+    # The watchdog command must work from its working directory, even when the updater package isn't installed.
+    import subprocess
+    environment = {name: value for name, value in os.environ.items() if name != "PYTHONPATH"}
+    result = subprocess.run(subprocess_popen.call_args[0][0][:3]+["--help"], cwd=subprocess_popen.call_args[1]["cwd"], env=environment, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert result.returncode == 0, result.stderr
+
+def test_check_install_health(tmp_path):
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, state_file=str(tmp_path / "state.json"))
+    assert updater.check_install_health() == True
+    updater.save_state(dict(install=dict(installed_at=1000, health_timeout=60, healthy=False)))
+    with mock.patch.object(updater, "rollback", return_value=True) as rollback:
+        with mock.patch("time.time", return_value=1030):
+            assert updater.check_install_health() == True
+        rollback.assert_not_called()
+        with mock.patch("time.time", return_value=1061):
+            assert updater.check_install_health(relaunch=False) == False
+        rollback.assert_called_once_with(relaunch=False)
+        updater.mark_healthy()
+        assert updater.load_state()["install"]["healthy"] == True
+        with mock.patch("time.time", return_value=1061):
+            assert updater.check_install_health() == True
+
 @pytest.mark.parametrize("system, bootstrap_file", [
         ("Windows", "bootstrap.exe"),
         ("Darwin", "bootstrap-mac.sh"),
@@ -149,3 +981,14 @@ def test_bootstrap_name(system, bootstrap_file):
     with mock.patch("platform.system", return_value=system):
         result = updater.bootstrap_name()
         assert result == bootstrap_file
+
+def test_app_path_and_executable():
+    global app_name, current_version, endpoint
+    updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version)
+    with mock.patch("updater.paths.app_path", return_value="running"):
+        with mock.patch("updater.paths.get_executable", return_value="running/app"):
+            assert updater.get_app_path() == "running"
+            assert updater.get_executable() == "running/app"
+            updater = core.UpdaterCore(endpoint=endpoint, app_name=app_name, current_version=current_version, app_path="/opt/app", executable="/opt/app/app")
+            assert updater.get_app_path() == "/opt/app"
+            assert updater.get_executable() == "/opt/app/app"
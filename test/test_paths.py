@@ -50,4 +50,19 @@ def test_app_path():
         assert mac_result == os.path.abspath(os.path.join("/path", "to"))
 
     paths.is_mac = old_value
-    del sys.frozen
\ No newline at end of file
+    del sys.frozen
+
+@pytest.mark.parametrize("system, environ, expected_base", [
+    ("Windows", {"APPDATA": os.path.join("C:", "Users", "user", "AppData", "Roaming")}, os.path.join("C:", "Users", "user", "AppData", "Roaming")),
+    ("Linux", {"XDG_DATA_HOME": os.path.join("/data", "home")}, os.path.join("/data", "home")),
+    ("Linux", {}, os.path.expanduser(os.path.join("~", ".local", "share"))),
+    ("Darwin", {}, os.path.expanduser(os.path.join("~", "Library", "Application Support"))),
+])
+def test_data_path(system, environ, expected_base):
+    with mock.patch.multiple("updater.paths", is_windows=system == "Windows", is_mac=system == "Darwin"):
+        with mock.patch.dict("os.environ", environ):
+            for variable in ("APPDATA", "XDG_DATA_HOME"):
+                if variable not in environ:
+                    os.environ.pop(variable, None)
+            result = paths.data_path("my app")
+    assert result == os.path.join(expected_base, "my app")
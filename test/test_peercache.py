@@ -0,0 +1,189 @@
+import os
+import errno
+import sys
+import socket
+import subprocess
+import threading
+import http.server
+import pytest
+from unittest import mock
+from updater import peercache, utils
+
+def start_peer(cache_directory):
+    """ Starts a peer cache in another process, as another computer in the network would, and returns the process and its URL. """
+    process = subprocess.Popen([sys.executable, "-m", "updater.peercache", "--cache-dir", str(cache_directory), "serve", "--port", "0"], stdout=subprocess.PIPE, universal_newlines=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    port = process.stdout.readline().split()[-1]
+    return process, "http://127.0.0.1:{}".format(port)
+
+@pytest.fixture
+def update_file(tmp_path):
+    path = tmp_path / "update.zip"
+    path.write_bytes(os.urandom(100000))
+    yield str(path), utils.hash_file(str(path))
+
+def test_add(tmp_path, update_file):
+    path, sha256 = update_file
+    cache = peercache.PeerCache(str(tmp_path / "cache"), max_files=2)
+    assert cache.has(sha256) == False
+    cache.add(path, sha256)
+    assert cache.has(sha256)
+    assert utils.hash_file(cache.path(sha256)) == sha256
+    # Old files are removed.
+    for data in (b"a", b"b"):
+        other = tmp_path / "other.zip"
+        other.write_bytes(data)
+        os.utime(cache.path(sha256), (0, 0))
+        cache.add(str(other), utils.hash_file(str(other)))
+    assert cache.has(sha256) == False
+    assert len(os.listdir(str(tmp_path / "cache"))) == 2
+
+def test_add_keeps_files_in_use(tmp_path, update_file):
+    path, sha256 = update_file
+    cache = peercache.PeerCache(str(tmp_path / "cache"), max_files=1)
+    cache.add(path, sha256)
+    os.utime(cache.path(sha256), (0, 0))
+    other = tmp_path / "other.zip"
+    other.write_bytes(b"other")
+    # On Windows, files being sent to a peer can't be removed.
+    with mock.patch("os.remove", side_effect=PermissionError(13, "File in use")):
+        cache.add(str(other), utils.hash_file(str(other)))
+    assert cache.has(utils.hash_file(str(other)))
+    assert cache.has(sha256)
+
+def test_add_failure_removes_temporary_file(tmp_path, update_file):
+    path, sha256 = update_file
+    cache = peercache.PeerCache(str(tmp_path / "cache"))
+    with mock.patch("os.link", side_effect=OSError):
+        with mock.patch("shutil.copyfile", side_effect=OSError(errno.ENOSPC, "No space left on device")):
+            with pytest.raises(OSError):
+                cache.add(path, sha256)
+    assert os.listdir(str(tmp_path / "cache")) == []
+
+def test_has_rejects_invalid_names(tmp_path):
+    cache = peercache.PeerCache(str(tmp_path))
+    (tmp_path / "secret").write_bytes(b"data")
+    assert cache.has("secret") == False
+    assert cache.has("../"+"a"*64) == False
+
+def test_fetch_from_local_cache(tmp_path, update_file):
+    path, sha256 = update_file
+    cache = peercache.PeerCache(str(tmp_path / "cache"))
+    cache.add(path, sha256)
+    destination = str(tmp_path / "download.zip")
+    assert cache.fetch(sha256, destination)
+    assert utils.hash_file(destination) == sha256
+
+def test_fetch_from_peers(tmp_path, update_file):
+    path, sha256 = update_file
+    # One peer without the file, one sending a corrupted file and one with the right file.
+    empty_directory = tmp_path / "empty"
+    empty_directory.mkdir()
+    corrupted_directory = tmp_path / "corrupted"
+    corrupted_directory.mkdir()
+    (corrupted_directory / sha256).write_bytes(b"corrupted")
+    good_directory = tmp_path / "good"
+    peercache.PeerCache(str(good_directory)).add(path, sha256)
+    processes = []
+    try:
+        peers = []
+        for directory in (empty_directory, corrupted_directory, good_directory):
+            process, url = start_peer(directory)
+            processes.append(process)
+            peers.append(url)
+        cache = peercache.PeerCache(str(tmp_path / "cache"), peers=peers)
+        destination = str(tmp_path / "download.zip")
+        assert cache.fetch(sha256, destination)
+        assert utils.hash_file(destination) == sha256
+        # Verified files are shared with other peers.
+        assert cache.has(sha256)
+        # No peer has this file, so it must be downloaded from the origin.
+        (tmp_path / "partial.zip").write_bytes(b"partial")
+        assert cache.fetch("0"*64, str(tmp_path / "partial.zip")) == False
+        assert (tmp_path / "partial.zip").read_bytes() == b"partial"
+        assert not os.path.exists(str(tmp_path / "partial.zip.peer"))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+            process.stdout.close()
+
+def test_fetch_when_cache_is_not_writable(tmp_path, update_file):
+    path, sha256 = update_file
+    server_cache = peercache.PeerCache(str(tmp_path / "server"), port=0)
+    server_cache.add(path, sha256)
+    port = server_cache.serve()
+    try:
+        cache = peercache.PeerCache(str(tmp_path / "cache"), peers=["http://127.0.0.1:{}".format(port)])
+        destination = str(tmp_path / "download.zip")
+        with mock.patch.object(cache, "add", side_effect=OSError(errno.EACCES, "Permission denied")):
+            assert cache.fetch(sha256, destination)
+        assert utils.hash_file(destination) == sha256
+    finally:
+        server_cache.stop()
+
+class OversizedRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Acts as a broken peer, which sends data without end and no Content-Length. """
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        try:
+            for index in range(1000):
+                self.wfile.write(b"a"*65536)
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+def test_fetch_rejects_unexpected_sizes(tmp_path, update_file):
+    path, sha256 = update_file
+    server_cache = peercache.PeerCache(str(tmp_path / "server"), port=0)
+    server_cache.add(path, sha256)
+    port = server_cache.serve()
+    oversized_server = http.server.HTTPServer(("127.0.0.1", 0), OversizedRequestHandler)
+    threading.Thread(target=oversized_server.serve_forever, daemon=True).start()
+    try:
+        destination = tmp_path / "download.zip"
+        # The right file, but its size doesn't match the update information.
+        cache = peercache.PeerCache(str(tmp_path / "cache"), peers=["http://127.0.0.1:{}".format(port)])
+        assert cache.fetch(sha256, str(destination), size=1000) == False
+        assert cache.fetch(sha256, str(destination), size=100000)
+        # Peers sending more data than expected are stopped.
+        cache = peercache.PeerCache(str(tmp_path / "other_cache"), peers=["http://127.0.0.1:{}".format(oversized_server.server_address[1])])
+        with mock.patch("updater.utils.hash_file") as hash_file:
+            assert cache.fetch(sha256, str(tmp_path / "oversized.zip"), size=100000) == False
+            assert cache.fetch(sha256, str(tmp_path / "oversized.zip")) == False
+            hash_file.assert_not_called()
+        assert not os.path.exists(str(tmp_path / "oversized.zip.peer"))
+    finally:
+        server_cache.stop()
+        oversized_server.shutdown()
+        oversized_server.server_close()
+
+def test_fetch_unreachable_peer(tmp_path, update_file):
+    path, sha256 = update_file
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    cache = peercache.PeerCache(str(tmp_path / "cache"), peers=["http://127.0.0.1:{}".format(port)], timeout=1)
+    assert cache.fetch(sha256, str(tmp_path / "download.zip")) == False
+
+def test_serve_and_discover(tmp_path, update_file):
+    path, sha256 = update_file
+    server_cache = peercache.PeerCache(str(tmp_path / "server"), discovery=True, port=0)
+    server_cache.add(path, sha256)
+    try:
+        port = server_cache.serve()
+    except OSError:
+        pytest.skip("Multicast is not available")
+    try:
+        client_cache = peercache.PeerCache(str(tmp_path / "client"), discovery=True, discovery_timeout=0.5)
+        peers = client_cache.discover(sha256)
+        if peers == []:
+            pytest.skip("Multicast is not available")
+        assert peers[0].endswith(":{}".format(port))
+        assert client_cache.fetch(sha256, str(tmp_path / "download.zip"))
+        assert utils.hash_file(str(tmp_path / "download.zip")) == sha256
+    finally:
+        server_cache.stop()
@@ -0,0 +1,68 @@
+import pytest
+from unittest import mock
+from updater import core, rollback
+
+@pytest.fixture
+def updater(tmp_path):
+    yield core.UpdaterCore(endpoint="", current_version="", state_file=str(tmp_path / "state.json"))
+
+def test_watch_healthy(updater):
+    updater.save_state(dict(install=dict(version="0.2", installed_at=1000, health_timeout=60, healthy=False)))
+
+    def mark_healthy(seconds):
+        updater.mark_healthy()
+
+    with mock.patch("time.sleep", side_effect=mark_healthy) as time_sleep:
+        with mock.patch("time.time", return_value=1000):
+            assert rollback.watch(updater) == 0
+        time_sleep.assert_called_once()
+
+def test_watch_timeout(updater):
+    updater.save_state(dict(install=dict(version="0.2", installed_at=1000, health_timeout=60, healthy=False)))
+    with mock.patch.object(updater, "rollback", return_value=True) as updater_rollback:
+        with mock.patch("time.time", return_value=1061):
+            assert rollback.watch(updater, relaunch=False) == 2
+        updater_rollback.assert_called_once_with(relaunch=False)
+
+def test_watch_without_update(updater):
+    assert rollback.watch(updater) == 1
+
+@pytest.mark.parametrize("command, arguments", [
+    ("restore", []),
+    ("restore", ["--no-relaunch"]),
+    ("restore", ["--version", "0.1"]),
+    ("watch", []),
+])
+def test_main(tmp_path, command, arguments):
+    state_file = str(tmp_path / "state.json")
+    with mock.patch("updater.core.UpdaterCore.rollback", return_value=True) as updater_rollback:
+        with mock.patch("updater.rollback.watch", return_value=0) as watch:
+            assert rollback.main(["--state-file", state_file, command]+arguments) == 0
+            if command == "watch":
+                assert watch.call_args[0][0].state_file == state_file
+            else:
+                version = arguments[1] if "--version" in arguments else None
+                updater_rollback.assert_called_once_with(relaunch="--no-relaunch" not in arguments, version=version)
+
+def test_main_nothing_to_restore(tmp_path):
+    assert rollback.main(["--state-file", str(tmp_path / "state.json"), "--no-relaunch", "restore"]) == 1
+
+def test_main_list(tmp_path, capsys):
+    state_file = str(tmp_path / "state.json")
+    for version in ("0.1", "0.2"):
+        (tmp_path / version).mkdir()
+    core.UpdaterCore(endpoint="", current_version="", state_file=state_file).save_state(dict(snapshots=[dict(version="0.1", snapshot=str(tmp_path / "0.1")), dict(version="0.2", snapshot=str(tmp_path / "0.2")), dict(version="0.3", snapshot=str(tmp_path / "missing"))]))
+    assert rollback.main(["--state-file", state_file, "list"]) == 0
+    assert capsys.readouterr().out.split() == ["0.1", "0.2"]
+
+def test_handle_watchdog_command(tmp_path):
+    with mock.patch("updater.rollback.watchdog_command_handled", False):
+        with mock.patch("updater.rollback.main") as main:
+            rollback.handle_watchdog_command(["app.exe", "--file", "document.txt"])
+            main.assert_not_called()
+            assert rollback.watchdog_command_handled == True
+            main.return_value = 2
+            with pytest.raises(SystemExit) as exit:
+                rollback.handle_watchdog_command(["app.exe", rollback.watchdog_argument, "--state-file", "state.json", "watch"])
+            main.assert_called_once_with(["--state-file", "state.json", "watch"])
+            assert exit.value.code == 2
@@ -15,7 +15,7 @@ wx.ID_NO = 5104
 sys.modules["wx"] = wx
 
 # now, import the wxupdater.
-from updater import wxupdater
+from updater import wxupdater, paths
 
 def test_initial_params():
     updater = wxupdater.WXUpdater(endpoint="https://example.com/update.zip", app_name="My awesome application", current_version="0.1")
@@ -86,9 +86,10 @@ def test_on_update_progress_on_100_percent():
     updater = wxupdater.WXUpdater(endpoint="https://example.com/update.zip", app_name="My awesome application", current_version="0.1")
     progressDialog = mock.Mock()
     with mock.patch("wx.ProgressDialog", return_value=progressDialog):
-        updater = updater.on_update_progress(100, 100)
+        updater.on_update_progress(100, 100)
         progressDialog.Show.assert_called_once()
         progressDialog.Destroy.assert_called_once()
+        assert updater.progress_dialog == None
 
 def test_on_update_almost_complete():
     updater = wxupdater.WXUpdater(endpoint="https://example.com/update.zip", app_name="My awesome application", current_version="0.1")
@@ -104,8 +105,8 @@ def test_check_for_updates_update_available(tempfile):
         with mock.patch.object(updater, "get_update_information") as get_update_information:
             with mock.patch.object(updater, "get_version_data") as get_version_data:
                 with mock.patch.object(updater, "on_new_update_available") as on_new_update_available:
-                    with mock.patch.object(updater, "download_update") as download_update:
-                        with mock.patch.object(updater, "extract_update") as extract_update:
+                    with mock.patch.object(updater, "get_update_path") as get_update_path:
+                        with mock.patch.object(updater, "download_update_path") as download_update_path:
                             with mock.patch.object(updater, "move_bootstrap") as move_bootstrap:
                                 with mock.patch.object(updater, "on_update_almost_complete") as on_update_almost_complete:
                                     with mock.patch.object(updater, "execute_bootstrap") as execute_bootstrap:
@@ -113,13 +114,83 @@ def test_check_for_updates_update_available(tempfile):
                                         execute_bootstrap.assert_called_once()
                                     on_update_almost_complete.assert_called_once()
                                 move_bootstrap.assert_called_once()
-                            extract_update.assert_called_once()
-                        download_update.assert_called_once()
+                            download_update_path.assert_called_once_with(get_update_path.return_value, "tmp", reference_path=paths.app_path())
+                        get_update_path.assert_called_once()
                     on_new_update_available.assert_called_once()
                 get_version_data.assert_called_once()
             get_update_information.assert_called_once()
         initialize.assert_called_once()
 
+@mock.patch("tempfile.mkdtemp", return_value="tmp")
+def test_check_for_updates_installs_extracted_update(tempfile):
+    updater = wxupdater.WXUpdater(endpoint="https://example.com/update.zip", app_name="My awesome application", current_version="0.1")
+    with mock.patch.object(updater, "initialize"):
+        with mock.patch.object(updater, "get_update_information"):
+            with mock.patch.object(updater, "get_version_data", return_value=("0.2", "changes", "https://example.com/update.zip")):
+                with mock.patch.object(updater, "on_new_update_available", return_value=True):
+                    with mock.patch.object(updater, "get_update_path", return_value=[dict(to="0.2", url="https://example.com/update.zip")]):
+                        with mock.patch.object(updater, "download_update_path", return_value="extracted"):
+                            with mock.patch.object(updater, "move_bootstrap", return_value="bootstrap") as move_bootstrap:
+                                with mock.patch.object(updater, "on_update_almost_complete"):
+                                    with mock.patch.object(updater, "execute_bootstrap") as execute_bootstrap:
+                                        updater.check_for_updates()
+                                        move_bootstrap.assert_called_once_with("extracted")
+                                        execute_bootstrap.assert_called_once_with("bootstrap", "extracted")
+
+def test_check_for_updates_prefetch():
+    updater = wxupdater.WXUpdater(endpoint="https://example.com/update.zip", app_name="My awesome application", current_version="0.1", prefetch=True, prefetch_rate=1024)
+    with mock.patch.object(updater, "initialize") as initialize:
+        with mock.patch.object(updater, "get_update_information"):
+            with mock.patch.object(updater, "get_version_data", return_value=("0.2", "changes", "https://example.com/update.zip")):
+                with mock.patch.object(updater, "on_new_update_available") as on_new_update_available:
+                    with mock.patch.object(updater, "get_update_path", return_value=[dict(to="0.2", url="https://example.com/update.zip")]):
+                        with mock.patch("threading.Thread") as thread:
+                            updater.check_for_updates()
+                            thread.assert_called_once_with(target=updater.prefetch_update, args=([dict(to="0.2", url="https://example.com/update.zip")],), daemon=True)
+                            thread.return_value.start.assert_called_once()
+                    # Users are not asked, nor progress displayed, until the update is staged.
+                    on_new_update_available.assert_not_called()
+                    initialize.assert_not_called()
+
+def test_check_for_updates_prefetch_in_progress():
+    updater = wxupdater.WXUpdater(endpoint="https://example.com/update.zip", app_name="My awesome application", current_version="0.1", prefetch=True)
+    with mock.patch.object(updater, "get_update_information"):
+        with mock.patch.object(updater, "get_version_data", return_value=("0.2", "changes", "https://example.com/update.zip")):
+            with mock.patch.object(updater, "get_update_path", return_value=[dict(to="0.2", url="https://example.com/update.zip")]):
+                with mock.patch("threading.Thread") as thread:
+                    thread.return_value.is_alive.return_value = True
+                    updater.check_for_updates()
+                    # A second check while the update is being staged doesn't start another thread.
+                    updater.check_for_updates()
+                    thread.assert_called_once()
+                    thread.return_value.is_alive.return_value = False
+                    updater.check_for_updates()
+                    assert thread.call_count == 2
+
+def test_prefetch_update():
+    updater = wxupdater.WXUpdater(endpoint="https://example.com/update.zip", app_name="My awesome application", current_version="0.1", prefetch=True, prefetch_rate=1024)
+    updater.update_version = "0.2"
+    with mock.patch.object(updater, "stage_update", return_value="staged") as stage_update:
+        with mock.patch("wx.CallAfter") as call_after:
+            updater.prefetch_update([dict(to="0.2", url="https://example.com/update.zip")])
+            stage_update.assert_called_once_with([dict(to="0.2", url="https://example.com/update.zip")], "0.2", max_rate=1024, reference_path=paths.app_path())
+            call_after.assert_called_once_with(updater.on_update_staged, "staged")
+    with mock.patch.object(updater, "stage_update", side_effect=OSError):
+        with mock.patch("wx.CallAfter") as call_after:
+            updater.prefetch_update([dict(to="0.2", url="https://example.com/update.zip")])
+            call_after.assert_not_called()
+
+@pytest.mark.parametrize("response", [True, False])
+def test_on_update_staged(response):
+    updater = wxupdater.WXUpdater(endpoint="https://example.com/update.zip", app_name="My awesome application", current_version="0.1", prefetch=True)
+    with mock.patch.object(updater, "on_new_update_available", return_value=response):
+        with mock.patch.object(updater, "install_update") as install_update:
+            updater.on_update_staged("staged")
+            if response:
+                install_update.assert_called_once_with("staged")
+            else:
+                install_update.assert_not_called()
+
 @mock.patch("tempfile.mkdtemp", return_value="tmp")
 def test_check_for_updates_no_update_available(tempfile):
     updater = wxupdater.WXUpdater(endpoint="https://example.com/update.zip", app_name="My awesome application", current_version="0.1")
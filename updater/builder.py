@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+""" Tools to generate updates from a folder of distributable files.
+
+This module takes the folder of a distributable application (for example, the output of Nuitka, Py2exe or cx_Freeze, with the bootstrapper already in place) and generates everything needed to publish an update:
+
+* The update zip file, compressed across all available CPU cores.
+* A json manifest with the sha256 hash of every file in the update.
+* The update json file expected by :py:func:`updater.core.UpdaterCore.get_version_data`. If the file already exists, the build is added to it, so a single update file can describe builds for several platforms.
+
+It can be used from the command line, either via the updater-build command or by running the module directly:
+
+.. code-block:: bash
+
+    python -m updater.builder dist/myapp --version 1.1 --description "Bug fixes." --base-url https://example.com/updates --output-dir public
+
+Or from python code, by calling :py:func:`build_update` and :py:func:`create_update_information`.
+"""
+import argparse
+import concurrent.futures
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+from . import utils
+
+log = logging.getLogger("updater.builder")
+
+def compress_file(path: str, temp_directory: str, compress_level: int = zlib.Z_DEFAULT_COMPRESSION, chunk_size: int = 1 << 20) -> Tuple[int, int, int, str, str]:
+    """ Compresses a file with raw deflate, as it is stored in zip files, computing its CRC32 and sha256 hash at the same time.
+
+    This function runs in worker processes started by :py:func:`build_update`.
+
+    :param path: Path of the file to compress.
+    :type path: str
+    :param temp_directory: Directory where the compressed data will be written.
+    :type temp_directory: str
+    :param compress_level: zlib compression level.
+    :type compress_level: int
+    :returns: A tuple of the form (crc32, file_size, compressed_size, sha256, compressed_path).
+    :rtype: tuple
+    """
+    crc = 0
+    file_size = 0
+    compressed_size = 0
+    file_hash = hashlib.sha256()
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    fd, compressed_path = tempfile.mkstemp(dir=temp_directory)
+    with open(path, "rb") as source, os.fdopen(fd, "wb") as destination:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            file_hash.update(chunk)
+            file_size += len(chunk)
+            compressed = compressor.compress(chunk)
+            compressed_size += len(compressed)
+            destination.write(compressed)
+        compressed = compressor.flush()
+        compressed_size += len(compressed)
+        destination.write(compressed)
+    return (crc, file_size, compressed_size, file_hash.hexdigest(), compressed_path)
+
+def list_files(source_directory: str) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    """ Lists the contents of a directory in a stable order.
+
+    :param source_directory: Directory to walk.
+    :type source_directory: str
+    :returns: A tuple of the form (files, empty_directories). Each item in both lists is a tuple of the form (path, name_in_archive).
+    :rtype: tuple
+    """
+    files = []
+    empty_directories = []
+    for root, directories, filenames in os.walk(source_directory):
+        directories.sort()
+        relative_root = os.path.relpath(root, source_directory)
+        if relative_root == os.curdir:
+            relative_root = ""
+        if not directories and not filenames and relative_root:
+            empty_directories.append((root, relative_root.replace(os.sep, "/")+"/"))
+        for filename in sorted(filenames):
+            files.append((os.path.join(root, filename), os.path.join(relative_root, filename).replace(os.sep, "/")))
+    return (files, empty_directories)
+
+def write_compressed_entry(archive: zipfile.ZipFile, path: str, arcname: str, crc: int, file_size: int, compressed_size: int, compressed_path: str) -> None:
+    """ Adds a file that has already been compressed by :py:func:`compress_file` to a zip archive opened for writing.
+
+    :py:class:`zipfile.ZipFile` always compresses the data it writes, so this function writes the local header and the deflate stream itself, and registers the entry so it is included in the central directory when the archive is closed.
+    """
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = compressed_size
+    zip64 = file_size > zipfile.ZIP64_LIMIT or compressed_size > zipfile.ZIP64_LIMIT
+    fp: Any = archive.fp
+    fp.seek(archive.start_dir)
+    zinfo.header_offset = archive.start_dir
+    fp.write(zinfo.FileHeader(zip64))
+    with open(compressed_path, "rb") as compressed:
+        shutil.copyfileobj(compressed, fp)
+    archive.start_dir = fp.tell()
+    archive.filelist.append(zinfo)
+    archive.NameToInfo[zinfo.filename] = zinfo
+    archive._didModify = True # type: ignore
+
+def build_update(source_directory: str, archive_path: str, jobs: Optional[int] = None, compress_level: int = zlib.Z_DEFAULT_COMPRESSION) -> Dict[str, str]:
+    """ Creates an update zip file with the contents of a directory. Files are placed in the root of the archive, as required by the updater.
+
+    Files are compressed and hashed in parallel, by using a pool of worker processes.
+
+    :param source_directory: Directory containing the distributable application.
+    :type source_directory: str
+    :param archive_path: Path of the zip file to create.
+    :type archive_path: str
+    :param jobs: Number of worker processes. If not provided, all CPU cores are used.
+    :type jobs: int
+    :param compress_level: zlib compression level, from 0 to 9.
+    :type compress_level: int
+    :returns: A dictionary mapping every file in the archive to its sha256 hash.
+    :rtype: dict
+    """
+    files, empty_directories = list_files(source_directory)
+    bootstrappers = ("bootstrap.exe", "bootstrap-lin.sh", "bootstrap-mac.sh")
+    if not any(arcname.endswith(bootstrappers) for path, arcname in files):
+        log.warning("No bootstrapper found in {}. Updates built from this directory can't be installed.".format(source_directory))
+    file_hashes: Dict[str, str] = {}
+    output_directory = os.path.dirname(os.path.abspath(archive_path))
+    with tempfile.TemporaryDirectory(dir=output_directory) as temp_directory:
+        compress = functools.partial(compress_file, temp_directory=temp_directory, compress_level=compress_level)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+                results = executor.map(compress, [path for path, arcname in files], chunksize=8)
+                for (path, arcname), (crc, file_size, compressed_size, file_hash, compressed_path) in zip(files, results):
+                    write_compressed_entry(archive, path, arcname, crc, file_size, compressed_size, compressed_path)
+                    os.remove(compressed_path)
+                    file_hashes[arcname] = file_hash
+                for path, arcname in empty_directories:
+                    archive.write(path, arcname)
+    log.debug("Update archive created at {}".format(archive_path))
+    return file_hashes
+
+def create_update_information(version: str, description: str, platform_key: str, update_url: str, archive_path: str, extracted_size: int, update_information: Optional[Dict[str, Any]] = None, files_url: Optional[str] = None) -> Dict[str, Any]:
+    """ Returns the update json information for a build, ready to be published.
+
+    :param version: Version of the update.
+    :type version: str
+    :param description: Description of the changes in this version.
+    :type description: str
+    :param platform_key: Key of the platform this build is for, as returned by :py:func:`updater.utils.get_platform_key`.
+    :type platform_key: str
+    :param update_url: URL where the update zip file will be published.
+    :type update_url: str
+    :param archive_path: Path to the update zip file.
+    :type archive_path: str
+    :param extracted_size: Total size, in bytes, of the files in the update.
+    :type extracted_size: int
+    :param update_information: Existing update information, with builds for other platforms. If its version matches, builds for other platforms are kept.
+    :type update_information: dict
+    :param files_url: URL where the json file with the hash of every file in the update will be published. Updaters use it to skip files that haven't changed.
+    :type files_url: str
+    :rtype: dict
+    """
+    if update_information == None or update_information.get("current_version") != version:
+        update_information = dict(current_version=version, description=description, downloads={})
+    update_information = dict(update_information)
+    update_information["current_version"] = version
+    update_information["description"] = description
+    sections: List[Tuple[str, Any]] = [("downloads", update_url), ("sha256", utils.hash_file(archive_path)), ("size", os.path.getsize(archive_path)), ("extracted_size", extracted_size)]
+    if files_url != None:
+        sections.append(("files", files_url))
+    for section, value in sections:
+        update_information[section] = dict(update_information.get(section, {}))
+        update_information[section][platform_key] = value
+    return update_information
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """ Parses command line arguments for :py:func:`main`. """
+    parser = argparse.ArgumentParser(prog="updater-build", description="Generates an update zip file and its update json file from a folder of distributable files.")
+    parser.add_argument("source_directory", help="Folder containing the distributable application, including the bootstrapper.")
+    parser.add_argument("--version", required=True, help="Version of the update.")
+    parser.add_argument("--base-url", required=True, help="URL of the folder where the update zip file will be published.")
+    parser.add_argument("--description", default="", help="Description of the changes in this version.")
+    parser.add_argument("--platform", default=utils.get_platform_key(), help="Platform key for this build, such as Windows64 or Linux64. Defaults to the current platform.")
+    parser.add_argument("--output-dir", default=os.curdir, help="Folder where the generated files will be written.")
+    parser.add_argument("--update-file", default="update.json", help="Name of the update json file inside the output folder. If it exists, this build is added to it.")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes. Defaults to the number of CPU cores.")
+    parser.add_argument("--compress-level", type=int, default=zlib.Z_DEFAULT_COMPRESSION, choices=range(0, 10), metavar="{0-9}", help="Compression level.")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """ Entry point for the updater-build command.
+
+    :returns: Process exit code.
+    :rtype: int
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    arguments = parse_arguments(argv)
+    if not os.path.isdir(arguments.source_directory):
+        log.error("{} is not a directory.".format(arguments.source_directory))
+        return 1
+    os.makedirs(arguments.output_dir, exist_ok=True)
+    archive_name = "update-{}-{}.zip".format(arguments.version, arguments.platform)
+    archive_path = os.path.join(arguments.output_dir, archive_name)
+    file_hashes = build_update(arguments.source_directory, archive_path, jobs=arguments.jobs, compress_level=arguments.compress_level)
+    manifest_path = os.path.splitext(archive_path)[0]+".files.json"
+    with open(manifest_path, "w") as f:
+        json.dump(file_hashes, f, indent=2, sort_keys=True)
+    extracted_size = sum(os.path.getsize(os.path.join(arguments.source_directory, *name.split("/"))) for name in file_hashes)
+    update_file = os.path.join(arguments.output_dir, arguments.update_file)
+    update_information = None
+    if os.path.exists(update_file):
+        with open(update_file, "r") as f:
+            update_information = json.load(f)
+    update_url = arguments.base_url.rstrip("/")+"/"+archive_name
+    files_url = arguments.base_url.rstrip("/")+"/"+os.path.basename(manifest_path)
+    update_information = create_update_information(arguments.version, arguments.description, arguments.platform, update_url, archive_path, extracted_size, update_information, files_url=files_url)
+    with open(update_file, "w") as f:
+        json.dump(update_information, f, indent=2)
+    log.info("Update for {} written to {} ({} files, {}).".format(arguments.platform, archive_path, len(file_hashes), utils.convert_bytes(os.path.getsize(archive_path))))
+    log.info("Update information written to {}".format(update_file))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+""" Updater implementation for computers without a graphical interface, such as servers and kiosks.
+
+This module allows you to perform unattended updates by instantiating the :py:class:`CLIUpdater` class and calling :py:func:`CLIUpdater.check_for_updates`. Instead of asking users, what happens with an available update is decided by policy flags, progress is written to the terminal, either as compact text or as one json object per line, and the result is returned as one of the exit codes defined in this module.
+
+Updates can be installed as soon as they are downloaded, when the application exits, or only downloaded, so they can be installed later by running the updater again:
+
+    >>> from updater.cliupdater import CLIUpdater
+    >>> updater = CLIUpdater(app_name="My app", current_version="0.1", endpoint="https://some_url.com", auto_accept=True, install_at_exit=True)
+    >>> updater.check_for_updates()
+
+It can also be used from the command line, via the updater-cli command or by running the module directly. This is useful for configuration management tools, which can act on the exit code:
+
+.. code-block:: bash
+
+    updater-cli --endpoint https://example.com/update.json --current-version 1.0 --app-name "My app" --app-path /opt/myapp --executable /opt/myapp/myapp --yes --progress json
+
+:note:
+    Updated files are copied over the application directory, so the application should not be running when an update is installed, unless it is the process running the updater.
+"""
+import argparse
+import atexit
+import json
+import logging
+import random
+import sys
+import time
+from typing import Any, List, Optional, TextIO, cast
+from pubsub import pub # type: ignore
+from pubsub.core.topicexc import TopicNameError # type: ignore
+from . import core, peercache, utils
+
+log = logging.getLogger("updater.CLIUpdater")
+
+#: The application is up to date.
+EXIT_UP_TO_DATE: int = 0
+#: The update check, download or installation failed.
+EXIT_ERROR: int = 1
+#: An update is available, but it has not been accepted.
+EXIT_UPDATE_AVAILABLE: int = 3
+#: An update has been downloaded and extracted, and is ready to be installed.
+EXIT_UPDATE_STAGED: int = 4
+#: An update is being installed, or will be installed when the process exits.
+EXIT_UPDATE_INSTALLING: int = 5
+
+class CLIUpdater(core.UpdaterCore):
+    """ Class to implement unattended updates from the command line.
+
+    :ivar auto_accept: Whether available updates are accepted without asking.
+    :ivar download_only: Whether accepted updates are only downloaded and extracted, without installing them.
+    :ivar install_at_exit: Whether accepted updates are installed when the process exits, instead of right away.
+    :ivar progress: Format of the progress report: "text", "json" or "none".
+    :ivar max_rate: Maximum download speed, in bytes per second. None means no limit.
+    :ivar splay: Maximum number of seconds to wait, at random, before checking for updates.
+    :ivar output: Stream where progress is reported.
+    :ivar unknown_size_step: When the server doesn't report the size of a download, progress is reported every time this number of bytes is received.
+    """
+
+    auto_accept: bool = False
+    download_only: bool = False
+    install_at_exit: bool = False
+    progress: str = "text"
+    max_rate: Optional[int] = None
+    splay: float = 0
+    unknown_size_step: int = 10*1024*1024
+
+    def __init__(self, auto_accept: bool = False, download_only: bool = False, install_at_exit: bool = False, progress: str = "text", max_rate: Optional[int] = None, splay: float = 0, output: Optional[TextIO] = None, *args, **kwargs):
+        """ class constructor.
+
+        It accepts all parameters required by :py:class:`updater.core.UpdaterCore`, plus the following:
+
+        :param auto_accept: If True, available updates are accepted without asking. Otherwise, users are asked only if the updater runs in an interactive terminal, and updates are not accepted when it doesn't.
+        :type auto_accept: bool
+        :param download_only: If True, accepted updates are downloaded and extracted into the staging directory (see :py:func:`updater.core.UpdaterCore.stage_update`), but not installed. The next run installs them without downloading them again.
+        :type download_only: bool
+        :param install_at_exit: If True, accepted updates are downloaded right away, but installed when the process exits.
+        :type install_at_exit: bool
+        :param progress: Format of the progress report. "text" writes a compact, human readable report, "json" writes a json object per line for every event, and "none" doesn't report anything.
+            (default is "text")
+        :type progress: str
+        :param max_rate: Maximum download speed, in bytes per second.
+        :type max_rate: int
+        :param splay: Maximum number of seconds to wait before checking for updates. The actual delay is random, so many computers updated at the same time don't reach the server together.
+            (default is 0)
+        :type splay: float
+        :param output: Stream where progress is reported.
+            (default is sys.stdout)
+        :type output: file
+        :raises: :py:exc:`ValueError` if progress is not a valid format.
+        """
+        super(CLIUpdater, self).__init__(*args, **kwargs)
+        if progress not in ("text", "json", "none"):
+            raise ValueError("Invalid progress format: {}".format(progress))
+        self.auto_accept = auto_accept
+        self.download_only = download_only
+        self.install_at_exit = install_at_exit
+        self.progress = progress
+        self.max_rate = max_rate
+        self.splay = splay
+        self.output = output or sys.stdout
+        self.last_step: Optional[int] = None
+        self.last_downloaded = 0
+        self.progress_line_open = False
+
+    def initialize(self) -> None:
+        """ Inits pubsub events for the updater, subscribing to the 'updater.update-progress' message. """
+        pub.subscribe(self.on_update_progress, "updater.update-progress")
+
+    def report(self, event: str, message: str, **data: Any) -> None:
+        """ Writes an event to :py:attr:`output` in the format selected by :py:attr:`progress`.
+
+        :param event: Name of the event, such as "update-available" or "installing". It is the "event" key of json reports.
+        :type event: str
+        :param message: Human readable description of the event, used in text reports.
+        :type message: str
+        :param data: Additional data included in json reports.
+        """
+        if self.progress_line_open:
+            # Finish the progress line written to the terminal.
+            self.output.write("\n")
+            self.progress_line_open = False
+        if self.progress == "json":
+            data = dict(event=event, **data)
+            self.output.write(json.dumps(data)+"\n")
+        elif self.progress == "text":
+            self.output.write(message+"\n")
+        self.output.flush()
+
+    def on_new_update_available(self) -> bool:
+        """ Decides whether the available update is accepted. It is accepted if :py:attr:`auto_accept` is set. Otherwise, the user is asked if the updater runs in an interactive terminal.
+
+        :returns: True if the update should be downloaded, False otherwise.
+        :rtype: bool
+        """
+        self.report("update-available", "{} {} is available.".format(self.app_name, self.update_version), version=self.update_version, description=self.update_description)
+        if self.auto_accept:
+            return True
+        if sys.stdin == None or not sys.stdin.isatty():
+            log.info("Update not accepted: the updater doesn't run in an interactive terminal and auto_accept is not set.")
+            return False
+        response = input("Changes:\n{}\nInstall it now? [y/N] ".format(self.update_description))
+        return response.strip().lower() in ("y", "yes")
+
+    def on_update_progress(self, total_downloaded: int, total_size: int) -> None:
+        """ Reports the download progress, when it goes up by at least one percent, or by ten percent in text reports written to a file or pipe. If the server doesn't report the size of the download, progress is reported every :py:attr:`unknown_size_step` bytes.
+
+        This function receives pubsub events sent by :py:func:`updater.core.UpdaterCore.download_update`.
+        """
+        if self.progress == "none":
+            return None
+        interactive = self.progress == "text" and self.output.isatty()
+        percentage: Optional[int] = None
+        if total_size > 0:
+            percentage = min(int((total_downloaded*100)/total_size), 100)
+            step = percentage if self.progress == "json" or interactive else percentage//10
+        else:
+            step = total_downloaded//self.unknown_size_step
+        if total_downloaded < self.last_downloaded:
+            # Updates made of several packages report progress for every download.
+            self.last_step = None
+        self.last_downloaded = total_downloaded
+        if self.last_step != None and step <= cast(int, self.last_step):
+            return None
+        self.last_step = step
+        if self.progress == "json":
+            self.report("progress", "", downloaded=total_downloaded, total=total_size if total_size > 0 else None, percentage=percentage)
+        else:
+            if percentage != None:
+                line = "Downloading... {}% ({} of {})".format(percentage, utils.convert_bytes(total_downloaded), utils.convert_bytes(total_size))
+            else:
+                line = "Downloading... {}".format(utils.convert_bytes(total_downloaded))
+            if interactive:
+                # Overwrite the same line, so the report stays compact.
+                self.output.write("\r"+line)
+                self.output.flush()
+                self.progress_line_open = True
+            else:
+                self.report("progress", line)
+        if total_size > 0 and total_downloaded >= total_size:
+            if self.progress_line_open:
+                self.output.write("\n")
+                self.output.flush()
+                self.progress_line_open = False
+            self.last_step = None
+            self.last_downloaded = 0
+
+    def on_update_almost_complete(self) -> None:
+        """ Reports that the update is about to be installed. """
+        self.report("installing", "Installing {} {}. The application will restart.".format(self.app_name, self.update_version), version=self.update_version)
+
+    def check_for_updates(self, force: bool = False) -> int:
+        """ Check for updates, and downloads and installs them according to the policy flags.
+
+        Updates are always staged with :py:func:`updater.core.UpdaterCore.stage_update`, so interrupted downloads are resumed on the next run.
+
+        :param force: If True, ignores any update information cached from a previous check. See :py:func:`updater.core.UpdaterCore.get_update_information`.
+        :type force: bool
+        :returns: One of the exit codes defined in this module.
+        :rtype: int
+        """
+        if self.splay > 0:
+            time.sleep(random.uniform(0, self.splay))
+        update_info = self.get_update_information(force=force)
+        version_data = self.get_version_data(update_info)
+        if version_data[0] == False:
+            self.report("up-to-date", "{} {} is up to date.".format(self.app_name, self.current_version), version=self.current_version)
+            return EXIT_UP_TO_DATE
+        self.update_version = version_data[0]
+        self.update_description = version_data[1]
+        update_path = self.get_update_path(update_info)
+        if self.on_new_update_available() == False:
+            return EXIT_UPDATE_AVAILABLE
+        self.initialize()
+        try:
+            extraction_path = self.stage_update(update_path, cast(str, self.update_version), max_rate=self.max_rate, reference_path=self.get_app_path())
+        finally:
+            pub.unsubscribe(self.on_update_progress, "updater.update-progress")
+        if self.download_only:
+            self.report("staged", "{} {} is ready to be installed.".format(self.app_name, self.update_version), version=self.update_version, path=extraction_path)
+            return EXIT_UPDATE_STAGED
+        if self.install_at_exit:
+            atexit.register(self.install_update, extraction_path)
+            self.report("install-scheduled", "{} {} will be installed when this process exits.".format(self.app_name, self.update_version), version=self.update_version)
+            return EXIT_UPDATE_INSTALLING
+        self.install_update(extraction_path)
+        return EXIT_UPDATE_INSTALLING
+
+    def install_update(self, extraction_path: str) -> None:
+        """ Moves the bootstrapper out of the extracted update, reports the installation and runs the bootstrapper.
+
+        :param extraction_path: Path where the update has been extracted.
+        :type extraction_path: str
+        """
+        bootstrap_exe = self.move_bootstrap(extraction_path)
+        self.on_update_almost_complete()
+        self.execute_bootstrap(bootstrap_exe, extraction_path)
+
+    def __del__(self) -> None:
+        """ Unsubscribe events before deleting this object. """
+        try:
+            pub.unsubscribe(self.on_update_progress, "updater.update-progress")
+        except TopicNameError:
+            pass
+
+def parse_arguments(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """ Parses command line arguments for :py:func:`main`. """
+    parser = argparse.ArgumentParser(prog="updater-cli", description="Checks for updates of an application, and downloads and installs them without user interaction. Exit codes: {} up to date, {} error, {} update available but not accepted, {} update staged, {} update being installed.".format(EXIT_UP_TO_DATE, EXIT_ERROR, EXIT_UPDATE_AVAILABLE, EXIT_UPDATE_STAGED, EXIT_UPDATE_INSTALLING))
+    parser.add_argument("--endpoint", required=True, help="URL of the update json file or catalog.")
+    parser.add_argument("--current-version", required=True, help="Version of the installed application.")
+    parser.add_argument("--app-name", default="", help="Name of the application.")
+    # Required, as the directory of the running program is the one of this command, not the application's.
+    parser.add_argument("--app-path", required=True, help="Directory of the application to update.")
+    parser.add_argument("--executable", required=True, help="Program to start after the update is installed.")
+    parser.add_argument("--channel", default="stable", help="Update channel to follow when the endpoint is a catalog.")
+    parser.add_argument("--state-file", default=None, help="Path to the state file of the updater.")
+    parser.add_argument("--check-interval", type=float, default=0, help="Seconds during which the result of the last check is reused.")
+    parser.add_argument("--force", action="store_true", help="Ignore update information cached by a previous check.")
+    parser.add_argument("-y", "--yes", action="store_true", dest="auto_accept", help="Accept available updates without asking.")
+    policy = parser.add_mutually_exclusive_group()
+    policy.add_argument("--download-only", action="store_true", help="Download and extract updates, but don't install them.")
+    policy.add_argument("--install-at-exit", action="store_true", help="Install updates when this process exits.")
+    parser.add_argument("--progress", choices=["text", "json", "none"], default="text", help="Format of the progress report.")
+    parser.add_argument("--max-rate", type=int, default=None, help="Maximum download speed, in bytes per second.")
+    parser.add_argument("--splay", type=float, default=0, help="Wait a random number of seconds, up to this value, before checking for updates.")
+    parser.add_argument("--peer", action="append", default=[], dest="peers", help="URL of a peer to retrieve updates from before the origin. Can be repeated.")
+    parser.add_argument("--peer-cache-dir", default=None, help="Directory where update files are kept to share them with peers. Required to use peers.")
+    parser.add_argument("--discovery", action="store_true", help="Discover peers in the local network via multicast.")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """ Entry point for the updater-cli command.
+
+    :returns: Process exit code, as defined in this module.
+    :rtype: int
+    """
+    arguments = parse_arguments(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    peer_cache = None
+    if arguments.peer_cache_dir != None:
+        peer_cache = peercache.PeerCache(arguments.peer_cache_dir, peers=arguments.peers, discovery=arguments.discovery)
+    elif arguments.peers or arguments.discovery:
+        log.error("--peer and --discovery require --peer-cache-dir.")
+        return EXIT_ERROR
+    updater = CLIUpdater(endpoint=arguments.endpoint, current_version=arguments.current_version, app_name=arguments.app_name, app_path=arguments.app_path, executable=arguments.executable, channel=arguments.channel, state_file=arguments.state_file, check_interval=arguments.check_interval, peer_cache=peer_cache, auto_accept=arguments.auto_accept, download_only=arguments.download_only, install_at_exit=arguments.install_at_exit, progress=arguments.progress, max_rate=arguments.max_rate, splay=arguments.splay)
+    try:
+        return updater.check_for_updates(force=arguments.force)
+    except Exception as error:
+        log.exception("Error while updating {}".format(arguments.app_name))
+        updater.report("error", "Update failed: {}".format(error), error=str(error))
+        return EXIT_ERROR
+
+if __name__ == "__main__":
+    sys.exit(main())
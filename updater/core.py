@@ -3,17 +3,34 @@
 This is the updater core class which provides all facilities other implementation should rely in.
 This class should not be used directly, use a derived class instead.
 """
+import collections
+import concurrent.futures
 import contextlib
+import errno
+import hashlib
+import heapq
+import http.client
 import io
+import math
 import os
 import platform
+import random
+import shutil
+import socket
+import ssl
+import sys
+import threading
+import time
 import zipfile
+import zlib
 import logging
 import json
+import urllib.error
+import urllib.parse
 import urllib.request
 from pubsub import pub # type: ignore
-from typing import Optional, Dict, Tuple, Union, Any
-from . import paths
+from typing import Optional, BinaryIO, Deque, Dict, Iterator, List, Tuple, Union, Any, cast
+from . import paths, peercache, utils
 log = logging.getLogger("updater.core")
 
 class UpdaterCore(object):
@@ -22,39 +39,390 @@ class UpdaterCore(object):
     Implementations must add user interaction methods and call logic for all methods present in this class.
     """
 
-    def __init__(self, endpoint: str, current_version: str, app_name: str = "", password: Optional[bytes] = None) -> None:
+    def __init__(self, endpoint: str, current_version: str, app_name: str = "", password: Optional[bytes] = None, check_interval: float = 0, state_file: Optional[str] = None, snapshot_retention: int = 0, health_timeout: Optional[float] = None, connect_timeout: Optional[float] = 10, read_timeout: Optional[float] = 30, retries: int = 2, retry_backoff: float = 0.5, hedge: bool = False, channel: str = "stable", peer_cache: Optional[peercache.PeerCache] = None, app_path: Optional[str] = None, executable: Optional[str] = None) -> None:
         """ 
         :param endpoint: The URl endpoint where the module should retrieve update information. It must return a json valid response or a non 200 HTTP status code.
         :type endpoint: str
         :param current_version: Application's current version.
         :type current_version: str
-        :param app_name: Name of the application.
+        :param app_name: Name of the application. It names the directory where the updater keeps its state, staged updates and snapshots (see :py:func:`updater.paths.data_path`), so it should be unique. If it is empty, a name derived from the endpoint is used instead.
             (default is empty)
         :type app_name: str
         :param password: Password for update zipfile.
         :type password: bytes
+        :param check_interval: Number of seconds during which the result of the last update check is reused instead of calling the endpoint again. Set it to 0 to check on every call.
+            (default is 0)
+        :type check_interval: float
+        :param state_file: Path to the json file where the updater persists its state between runs. If not provided, a file inside :py:func:`updater.paths.data_path` is used.
+        :type state_file: str
+        :param snapshot_retention: Number of snapshots of previous versions to keep, so updates can be rolled back. See :py:func:`create_snapshot`. Set it to 0 to disable snapshots.
+            (default is 0)
+        :type snapshot_retention: int
+        :param health_timeout: Number of seconds the new version has to call :py:func:`mark_healthy` after an update is installed. If it doesn't, the previous version is restored. Requires snapshots. See :py:func:`start_watchdog`.
+        :type health_timeout: float
+        :param connect_timeout: Seconds to wait for the server to accept a connection or to send any data, for every request. None waits forever.
+            (default is 10)
+        :type connect_timeout: float
+        :param read_timeout: Maximum number of seconds to receive the whole update information. None waits forever.
+            (default is 30)
+        :type read_timeout: float
+        :param retries: Number of times a request for update information is retried after a transient error, such as a timeout, a connection error or a 5xx or 429 HTTP status. See :py:func:`is_transient_error`.
+            (default is 2)
+        :type retries: int
+        :param retry_backoff: Base delay between retries, in seconds. The delay before retry n is a random value between 0 and retry_backoff*2**n.
+            (default is 0.5)
+        :type retry_backoff: float
+        :param hedge: If True, a second request for update information is sent if the first one doesn't finish within the 95th percentile of previous response times, and the first response is used. See :py:func:`get_hedge_delay`.
+        :type hedge: bool
+        :param channel: Update channel to follow when the endpoint returns a catalog. See :py:func:`get_catalog_entry`.
+            (default is "stable")
+        :type channel: str
+        :param peer_cache: Cache used to retrieve update packages from other computers in the local network before downloading them from their URL, and to share them afterwards. See :py:mod:`updater.peercache`.
+        :type peer_cache: :py:class:`updater.peercache.PeerCache`
+        :param app_path: Directory of the application to update. If not provided, the directory of the running application is used. See :py:func:`updater.paths.app_path`.
+        :type app_path: str
+        :param executable: Program to start after the update is installed. If not provided, the running application is started again. See :py:func:`updater.paths.get_executable`.
+        :type executable: str
         """
         self.endpoint = endpoint
         self.current_version = current_version
         self.app_name = app_name
         self.password = password
-        self.update_version = None
-        self.update_description = None
+        self.update_version: Union[bool, str, None] = None
+        self.update_description: Union[bool, str, None] = None
+        self.check_interval = check_interval
+        if app_name == "":
+            # Applications without a name mustn't share their state, staged updates and snapshots with each other.
+            app_directory = "updater-{}".format(hashlib.sha256(endpoint.encode("utf-8")).hexdigest()[:12])
+            log.debug("No app_name provided, using {} as data directory name".format(app_directory))
+        else:
+            app_directory = app_name
+        self.data_directory = paths.data_path(app_directory)
+        if state_file == None:
+            state_file = os.path.join(self.data_directory, "updater_state.json")
+        self.state_file = cast(str, state_file)
+        self.snapshot_retention = snapshot_retention
+        self.snapshot_directory = os.path.join(self.data_directory, "snapshots")
+        self.health_timeout = health_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.hedge = hedge
+        self.channel = channel
+        self.peer_cache = peer_cache
+        self.app_path = app_path
+        self.executable = executable
+        self.response_times: Optional[Deque[float]] = None
+        self.state_lock = threading.RLock()
+        self.state_lock_depth = 0
+
+    def get_app_path(self) -> str:
+        """ Returns the directory of the application to update: :py:attr:`app_path` if set, or the directory of the running application otherwise.
+
+        :rtype: str
+        """
+        if self.app_path != None:
+            return cast(str, self.app_path)
+        return paths.app_path()
+
+    def get_executable(self) -> str:
+        """ Returns the program started after installing an update: :py:attr:`executable` if set, or the running application otherwise.
+
+        :rtype: str
+        """
+        if self.executable != None:
+            return cast(str, self.executable)
+        return paths.get_executable()
+
+    def load_state(self) -> Dict[str, Any]:
+        """ Reads the state persisted by :py:func:`save_state`. A missing or unreadable state file is treated as an empty state.
+
+        :rtype: dict
+        """
+        try:
+            with open(self.state_file, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(state, dict):
+            return {}
+        return state
+
+    def save_state(self, state: Dict[str, Any]) -> None:
+        """ Writes the updater state to :py:attr:`state_file`. The file is replaced atomically, so a crash while saving will never leave a half written state behind.
+
+        Errors are logged and ignored, as the state is only used to save work in later runs.
+
+        :param state: Dictionary to persist. It must be json serializable.
+        :type state: dict
+        """
+        temp_file = self.state_file+".tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+            with open(temp_file, "w") as f:
+                json.dump(state, f)
+            os.replace(temp_file, self.state_file)
+        except OSError:
+            log.exception("Unable to save updater state to {}".format(self.state_file))
+
+    @contextlib.contextmanager
+    def lock_state(self) -> Iterator[None]:
+        """ Context manager that holds an exclusive lock on :py:attr:`state_file`, so other threads and processes using the same state file (the application, the updater-rollback command and the rollback watchdog) don't overwrite each other's changes. The lock can be taken again by the thread holding it.
+
+        If the lock file can't be created, the state is used without a lock.
+        """
+        with self.state_lock:
+            lock_file = None
+            if self.state_lock_depth == 0:
+                try:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+                    lock_file = open(self.state_file+".lock", "a+b")
+                    if sys.platform == "win32":
+                        import msvcrt
+                        while True:
+                            try:
+                                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                                break
+                            except OSError as error:
+                                # LK_LOCK gives up after 10 seconds.
+                                if error.errno != errno.EDEADLOCK:
+                                    raise
+                    else:
+                        import fcntl
+                        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                except OSError:
+                    log.exception("Unable to lock updater state file {}".format(self.state_file))
+                    if lock_file != None:
+                        lock_file.close()
+                        lock_file = None
+            self.state_lock_depth += 1
+            try:
+                yield None
+            finally:
+                self.state_lock_depth -= 1
+                if lock_file != None:
+                    # Closing the file releases the lock.
+                    lock_file.close()
+
+    @contextlib.contextmanager
+    def update_state(self) -> Iterator[Dict[str, Any]]:
+        """ Context manager to change the updater state. The state is loaded with :py:func:`load_state` and saved with :py:func:`save_state` when the block ends without errors, while holding :py:func:`lock_state`.
+
+        .. code-block:: python
+
+            with updater.update_state() as state:
+                state["key"] = "value"
+        """
+        with self.lock_state():
+            state = self.load_state()
+            yield state
+            self.save_state(state)
 
-    def get_update_information(self) -> Dict[str, Any]:
+    def get_cached_update_information(self) -> Optional[Dict[str, Any]]:
+        """ Returns the update information saved by the last check, if it is still valid.
+
+        The cached information is valid if it was retrieved less than :py:attr:`check_interval` seconds ago, from the same endpoint and channel, and while running the same :py:attr:`current_version`.
+
+        :returns: The cached update information or None.
+        :rtype: dict
+        """
+        if self.check_interval <= 0:
+            return None
+        last_check = self.load_state().get("last_check")
+        if not isinstance(last_check, dict):
+            return None
+        if last_check.get("endpoint") != self.endpoint or last_check.get("channel") != self.channel or last_check.get("current_version") != self.current_version:
+            return None
+        elapsed = time.time()-last_check.get("checked_at", 0)
+        if elapsed < 0 or elapsed >= self.check_interval:
+            return None
+        return last_check.get("content")
+
+    def get_update_information(self, force: bool = False) -> Dict[str, Any]:
         """ Calls the provided URL endpoint and returns information about the available update sent by the server. The format should adhere to the json specifications for updates.
 
         If the server returns a status code different to 200 or the json file is not valid, this will raise either a :py:exc:`urllib.error.HTTPError` or a :external:py:exc:`json.JSONDecodeError`.
 
+        Transient errors are retried up to :py:attr:`retries` times, with a random exponential backoff, before being raised. See :py:func:`request_update_information` for timeouts and hedged requests.
+
+        If the endpoint returns a catalog, only the entry for :py:attr:`channel` and the current platform is retrieved and returned. See :py:func:`get_catalog_entry`.
+
+        When :py:attr:`check_interval` is set, the result of a check is persisted and returned by later calls without contacting the endpoint, until the interval expires. See :py:func:`get_cached_update_information`.
+
+        :param force: If True, always calls the endpoint even if there is a valid cached result.
+        :type force: bool
         :rtype: dict
         """
-        headers = {"User-Agent": f"{self.app_name}/{self.current_version}"}
-        req = urllib.request.Request(self.endpoint, headers=headers)
-        with urllib.request.urlopen(req) as response:
-            data: str = response.read()
+        if force == False:
+            cached_content = self.get_cached_update_information()
+            if cached_content != None:
+                log.debug("Using update information cached from a previous check.")
+                return cast(Dict[str, Any], cached_content)
+        content = self.get_catalog_entry(self.load_update_file(self.endpoint), self.endpoint)
+        if self.check_interval > 0 or self.hedge:
+            with self.update_state() as state:
+                if self.check_interval > 0:
+                    state["last_check"] = dict(endpoint=self.endpoint, channel=self.channel, current_version=self.current_version, checked_at=time.time(), content=content)
+                if self.hedge:
+                    state["response_times"] = list(self.get_response_times())
+        return content
+
+    def load_update_file(self, url: str) -> Dict[str, Any]:
+        """ Retrieves and parses a json update file. Transient errors are retried up to :py:attr:`retries` times, with a random exponential backoff, before being raised.
+
+        :param url: URL of the update file.
+        :type url: str
+        :rtype: dict
+        """
+        for attempt in range(self.retries+1):
+            try:
+                data = self.request_update_information(url)
+                break
+            except Exception as error:
+                if attempt == self.retries or not self.is_transient_error(error):
+                    raise
+                delay = random.uniform(0, self.retry_backoff*2**attempt)
+                log.warning("Error retrieving update information ({}), retrying in {:.2f} seconds".format(error, delay))
+                time.sleep(delay)
         content: Dict[str, Any] = json.loads(data)
         return content
 
+    def get_catalog_entry(self, content: Dict[str, Any], base_url: Optional[str] = None) -> Dict[str, Any]:
+        """ Selects the update information for :py:attr:`channel` and the current platform from a catalog. Update files without a "channels" section are returned unchanged.
+
+        A catalog is a small index that points to the update information of every channel, optionally split by platform key (see :py:func:`updater.utils.get_platform_key`). Entries can be included inline, or be URLs (relative to the file that contains them) that are only retrieved when they are needed::
+
+            {"channels": {
+                "stable": {"Windows64": "stable/windows64.json", "Linux64": "stable/linux64.json"},
+                "beta": "beta.json",
+                "nightly": {"current_version": "2.1-dev", "description": "Nightly build.", "downloads": {"Windows64": "https://example.com/nightly.zip"}}
+            }}
+
+        This method can raise a KeyError if the catalog doesn't include the channel or the current platform.
+
+        :param content: Update information, as returned by the endpoint.
+        :type content: dict
+        :param base_url: URL content was retrieved from, used to resolve relative URLs.
+        :type base_url: str
+        :returns: Update information in the format expected by :py:func:`get_version_data`.
+        :rtype: dict
+        """
+        if "channels" not in content:
+            return content
+        if self.channel not in content["channels"]:
+            log.error("Update catalog doesn't include channel {}".format(self.channel))
+            raise KeyError("Update catalog doesn't include channel {}.".format(self.channel))
+        entry: Any = content["channels"][self.channel]
+        url = base_url or self.endpoint
+        platform_selected = False
+        while True:
+            if isinstance(entry, str):
+                url = urllib.parse.urljoin(url, entry)
+                log.debug("Retrieving catalog entry from {}".format(url))
+                entry = self.load_update_file(url)
+            elif "current_version" in entry:
+                return cast(Dict[str, Any], entry)
+            elif platform_selected == False:
+                update_url_key = utils.get_platform_key()
+                if update_url_key not in entry:
+                    log.error("Update catalog doesn't include architecture {} for channel {}".format(update_url_key, self.channel))
+                    raise KeyError("Update catalog doesn't include current architecture.")
+                entry = entry[update_url_key]
+                platform_selected = True
+            else:
+                raise KeyError("Update catalog entry for channel {} is not valid.".format(self.channel))
+
+    def fetch_update_information(self, url: Optional[str] = None) -> bytes:
+        """ Performs a single request to the URL endpoint, or to url if provided, and returns the response body, enforcing :py:attr:`connect_timeout` and :py:attr:`read_timeout`. The time taken by successful requests is recorded for :py:func:`get_hedge_delay`.
+
+        :rtype: bytes
+        """
+        headers = {"User-Agent": f"{self.app_name}/{self.current_version}"}
+        req = urllib.request.Request(url or self.endpoint, headers=headers)
+        started_at = time.monotonic()
+        chunks = []
+        with urllib.request.urlopen(req, timeout=self.connect_timeout) as response:
+            while True:
+                chunk = response.read(io.DEFAULT_BUFFER_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                if self.read_timeout != None and time.monotonic()-started_at > cast(float, self.read_timeout):
+                    raise socket.timeout("Update information was not received in {} seconds".format(self.read_timeout))
+        self.get_response_times().append(time.monotonic()-started_at)
+        return b"".join(chunks)
+
+    def request_update_information(self, url: Optional[str] = None) -> bytes:
+        """ Returns the response body of the URL endpoint, or of url if provided, as :py:func:`fetch_update_information` does.
+
+        If :py:attr:`hedge` is enabled and the request has not finished after :py:func:`get_hedge_delay` seconds, a second request is sent, and whichever finishes first is used. An error is raised only if both requests fail.
+
+        :rtype: bytes
+        """
+        if self.hedge == False:
+            return self.fetch_update_information(url)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        try:
+            pending = {executor.submit(self.fetch_update_information, url)}
+            done, pending = concurrent.futures.wait(pending, timeout=self.get_hedge_delay())
+            if not done:
+                log.debug("Update information request is slow, sending a hedged request")
+                pending.add(executor.submit(self.fetch_update_information, url))
+            error: Optional[BaseException] = None
+            while done or pending:
+                for future in done:
+                    error = future.exception()
+                    if error == None:
+                        return cast(bytes, future.result())
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            raise cast(BaseException, error)
+        finally:
+            # Don't wait for the slowest request, it will finish or time out in the background.
+            executor.shutdown(wait=False)
+
+    def get_response_times(self) -> Deque[float]:
+        """ Returns the durations, in seconds, of the latest successful requests for update information. When hedging is enabled, they are persisted in the state file between runs.
+
+        :rtype: :py:class:`collections.deque`
+        """
+        if self.response_times == None:
+            saved_times = self.load_state().get("response_times", []) if self.hedge else []
+            self.response_times = collections.deque(saved_times, maxlen=50)
+        return cast(Deque[float], self.response_times)
+
+    def get_hedge_delay(self) -> float:
+        """ Returns how long to wait for a request before sending a hedged one: the 95th percentile of previous response times, or 1 second if less than 5 responses have been recorded.
+
+        :rtype: float
+        """
+        response_times = sorted(self.get_response_times())
+        if len(response_times) < 5:
+            return 1.0
+        return response_times[math.ceil(len(response_times)*0.95)-1]
+
+    def is_transient_error(self, error: BaseException) -> bool:
+        """ Checks whether an error retrieving update information is likely to go away by trying again: timeouts, network and connection errors, HTTP status codes 429 and 5xx, and malformed HTTP responses.
+
+        Errors wrapped by a :py:exc:`urllib.error.URLError` are checked by their reason. Errors that won't change by retrying are not transient: invalid certificates, unsupported or malformed URLs and host names that don't exist. A temporary failure to resolve a host name is transient.
+
+        :rtype: bool
+        """
+        if isinstance(error, urllib.error.HTTPError):
+            return error.code == 429 or error.code >= 500
+        if isinstance(error, urllib.error.URLError):
+            # The reason is a string for errors raised by urllib itself, such as "unknown url type".
+            if not isinstance(error.reason, BaseException):
+                return False
+            return self.is_transient_error(error.reason)
+        if isinstance(error, ssl.SSLCertVerificationError):
+            return False
+        if isinstance(error, socket.gaierror):
+            return error.errno == socket.EAI_AGAIN
+        return isinstance(error, (OSError, http.client.HTTPException))
+
     def get_version_data(self, content: Dict[str, Any]) -> Tuple[Union[bool, str], Union[bool, str], Union[bool, str]]:
         """ Parses the dictionary returned by :py:func:`updater.core.updaterCore.get_update_information` and, if there is a new update available, returns information about it in a tuple.
 
@@ -64,11 +432,14 @@ class UpdaterCore(object):
 
         This method can raise a KeyError if there are no updates for the current architecture defined in the update file.
 
+        Catalogs with inline entries are also accepted, in which case the entry for :py:attr:`channel` is used. See :py:func:`get_catalog_entry`.
+
         :returns: tuple with update information or False values.
         :rtype: tuple
         """
+        content = self.get_catalog_entry(content)
         available_version = content["current_version"]
-        update_url_key = platform.system()+platform.architecture()[0][:2]
+        update_url_key = utils.get_platform_key()
         if available_version == self.current_version:
             return (False, False, False)
         if content["downloads"].get(update_url_key) == None:
@@ -78,7 +449,66 @@ class UpdaterCore(object):
         update_url = content ['downloads'][update_url_key]
         return (available_version, available_description, update_url)
 
-    def download_update(self, update_url: str, update_destination: str, chunk_size: int = io.DEFAULT_BUFFER_SIZE) -> str:
+    def get_update_path(self, content: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """ Computes the cheapest sequence of packages, by total download size, needed to update from :py:attr:`current_version` to the version reported in the update file.
+
+        Besides the full package in the downloads section, the update file might contain a "packages" section, which lists, for every platform, packages that update the application between two versions. Every package is a dictionary with the keys "url", "to" (the version the package updates to), "size" (download size, in bytes) and, optionally, "extracted_size" (size of its contents, in bytes). Packages with a "from" key are deltas, which can only be applied to that version and contain just the files that changed; packages without it contain the full application::
+
+            "packages": {"Windows64": [
+                {"from": "1.2", "to": "1.3", "url": "https://example.com/1.2-1.3.zip", "size": 1048576},
+                {"from": "1.3", "to": "1.5", "url": "https://example.com/1.3-1.5.zip", "size": 2097152}
+            ]}
+
+        The full package in the downloads section is always considered, using its size from the "size" section, its hash from the "sha256" section and its file list from the "files" section, if present. Packages with a "sha256" key are verified after being downloaded. Packages with a "files" key point to a json file with the sha256 hash of every file they contain, as written by :py:mod:`updater.builder`, which is used to skip unchanged files. See :py:func:`extract_update`.
+
+        This method can raise a KeyError if there are no packages leading to the new version for the current architecture.
+
+        :returns: List of packages to download and extract, in order.
+        :rtype: list
+        """
+        content = self.get_catalog_entry(content)
+        update_url_key = utils.get_platform_key()
+        target_version = content["current_version"]
+        packages: List[Dict[str, Any]] = list(content.get("packages", {}).get(update_url_key, []))
+        if content["downloads"].get(update_url_key) != None:
+            full_size = content.get("size", {}).get(update_url_key)
+            extracted_size = content.get("extracted_size", {}).get(update_url_key)
+            sha256 = content.get("sha256", {}).get(update_url_key)
+            files = content.get("files", {}).get(update_url_key)
+            packages.append(dict(to=target_version, url=content["downloads"][update_url_key], size=full_size, extracted_size=extracted_size, sha256=sha256, files=files))
+        # Packages without size are only used when there is no other choice.
+        unknown_size = sum(package.get("size") or 0 for package in packages)+1
+        # Dijkstra over versions. Ties in size are resolved in favour of fewer downloads.
+        queue: List[Tuple[int, int, int, str]] = [(0, 0, -1, self.current_version)]
+        best: Dict[str, Tuple[int, int]] = {self.current_version: (0, 0)}
+        previous: Dict[str, Tuple[str, int]] = {}
+        while queue:
+            size, hops, _, version = heapq.heappop(queue)
+            if version == target_version:
+                break
+            if best.get(version, (size, hops)) < (size, hops):
+                continue
+            for index, package in enumerate(packages):
+                if package.get("from", version) != version:
+                    continue
+                next_cost = (size+(package.get("size") or unknown_size), hops+1)
+                next_version = package["to"]
+                if next_version not in best or next_cost < best[next_version]:
+                    best[next_version] = next_cost
+                    previous[next_version] = (version, index)
+                    heapq.heappush(queue, (next_cost[0], next_cost[1], index, next_version))
+        if target_version not in previous:
+            log.error("Update file doesn't include packages to update to {} for architecture {}".format(target_version, update_url_key))
+            raise KeyError("Update file doesn't include packages for current architecture.")
+        update_path: List[Dict[str, Any]] = []
+        version = target_version
+        while version != self.current_version:
+            version, index = previous[version]
+            update_path.insert(0, packages[index])
+        log.debug("Update path to {}: {}".format(target_version, [package["url"] for package in update_path]))
+        return update_path
+
+    def download_update(self, update_url: str, update_destination: str, chunk_size: int = io.DEFAULT_BUFFER_SIZE, resume: bool = False, max_rate: Optional[int] = None, extracted_size: Optional[int] = None, extraction_path: Optional[str] = None) -> str:
         """ Downloads an update URL and notifies all subscribers of the download progress.
 
         This function will send a pubsub notification every time the download progress updates by using :py:func:`pubsub.pub.sendMessage` under the topic "updater.update-progress".
@@ -95,44 +525,330 @@ class UpdaterCore(object):
         :type update_destination: str
         :param chunk_size: chunk size for downloading the update (default to :py:data:`io.DEFAULT_BUFFER_SIZE`)
         :type chunk_size: int
+        :param resume: If True and update_destination already contains part of the file, only the remaining bytes are requested from the server. If the server does not support range requests, the file is downloaded again from the beginning.
+        :type resume: bool
+        :param max_rate: Maximum download speed, in bytes per second. If not provided, the download is not throttled.
+        :type max_rate: int
+        :param extracted_size: Size, in bytes, the update will take once extracted. If provided together with extraction_path, free space for the extraction is checked before downloading.
+        :type extracted_size: int
+        :param extraction_path: Path where the update will be extracted.
+        :type extraction_path: str
         :returns: The update file path in the system.
         :rtype: str
+        :raises: :py:exc:`OSError` with errno set to :py:data:`errno.ENOSPC` if there is not enough free space for the update, and :py:exc:`urllib.error.ContentTooShortError` if the connection is closed before the whole file is received. In the latter case, the download can be resumed.
+
+        Before receiving any data, free space is checked by using the Content-Length reported by the server (see :py:func:`check_free_space`), and the whole file is allocated on disk. While downloading, the number of bytes written is kept in a file next to update_destination, with the ".progress" extension, which allows resuming downloads into an already allocated file.
         """
-        request = urllib.request.Request(update_url, headers={"User-Agent": f"{self.app_name}/{self.current_version}"})
-        with urllib.request.urlopen(request) as response:
+        headers = {"User-Agent": f"{self.app_name}/{self.current_version}"}
+        progress_path = update_destination+".progress"
+        offset = 0
+        if resume and os.path.exists(progress_path) and os.path.exists(update_destination):
+            with open(progress_path, "r") as f:
+                offset = int(f.read() or 0)
+        elif resume and os.path.exists(update_destination):
+            offset = os.path.getsize(update_destination)
+        if offset > 0:
+            headers["Range"] = "bytes={}-".format(offset)
+        request = urllib.request.Request(update_url, headers=headers)
+        try:
+            response = urllib.request.urlopen(request, timeout=self.connect_timeout)
+        except urllib.error.HTTPError as error:
+            # 416 means that there is nothing left to download after offset.
+            if offset > 0 and error.code == 416:
+                log.debug("Update was already downloaded")
+                if os.path.exists(progress_path):
+                    os.remove(progress_path)
+                return update_destination
+            raise
+        with response:
+            if offset > 0 and getattr(response, "status", None) == 206:
+                log.debug("Resuming update download from byte {}".format(offset))
+                downloaded_size = offset
+            else:
+                downloaded_size = 0
             total_size = int(response.headers.get("Content-Length", -1))
-            downloaded_size = 0
-            with open(update_destination, "wb") as out_file:
+            if total_size >= 0:
+                total_size = total_size+downloaded_size
+            required_space: Dict[str, int] = {}
+            if total_size >= 0:
+                allocated_size = os.path.getsize(update_destination) if downloaded_size > 0 else 0
+                required_space[update_destination] = max(total_size-allocated_size, 0)
+            if extracted_size != None and extraction_path != None:
+                required_space[cast(str, extraction_path)] = cast(int, extracted_size)
+            self.check_free_space(required_space)
+            with open(progress_path, "w") as f:
+                f.write(str(downloaded_size))
+            with open(update_destination, "r+b" if downloaded_size > 0 else "wb") as out_file:
+                if downloaded_size == 0 and total_size > 0:
+                    self.preallocate_file(out_file, total_size)
+                out_file.seek(downloaded_size)
+                session_size = 0
+                saved_size = downloaded_size
+                started_at = time.monotonic()
                 while True:
                     chunk = response.read(chunk_size)
                     if not chunk:
                         break
                     out_file.write(chunk)
                     downloaded_size += len(chunk)
+                    session_size += len(chunk)
+                    if downloaded_size-saved_size >= 1 << 20:
+                        out_file.flush()
+                        with open(progress_path, "w") as f:
+                            f.write(str(downloaded_size))
+                        saved_size = downloaded_size
                     pub.sendMessage("updater.update-progress", total_downloaded=downloaded_size, total_size=total_size)
+                    if max_rate:
+                        delay = session_size/max_rate-(time.monotonic()-started_at)
+                        if delay > 0:
+                            time.sleep(delay)
+                if total_size >= 0 and downloaded_size < total_size:
+                    out_file.flush()
+                    with open(progress_path, "w") as f:
+                        f.write(str(downloaded_size))
+                    raise urllib.error.ContentTooShortError("Update download incomplete: got only {} out of {} bytes".format(downloaded_size, total_size), (update_destination, response.headers))
+                out_file.truncate(downloaded_size)
+        os.remove(progress_path)
         log.debug("Update downloaded")
         return update_destination
 
-    def extract_update(self, update_archive: str, destination: str) -> str:
+    def check_free_space(self, required_space: Dict[str, int]) -> None:
+        """ Checks that there is enough free space to write the given amount of bytes in every path. Paths don't need to exist yet, and requirements for paths in the same volume are added together.
+
+        :param required_space: Dictionary mapping paths to the number of bytes that will be written under them.
+        :type required_space: dict
+        :raises: :py:exc:`OSError` with errno set to :py:data:`errno.ENOSPC` if any of the volumes doesn't have enough free space.
+        """
+        volumes: Dict[int, Tuple[str, int]] = {}
+        for path, size in required_space.items():
+            existing_path = os.path.abspath(path)
+            while not os.path.exists(existing_path) and os.path.dirname(existing_path) != existing_path:
+                existing_path = os.path.dirname(existing_path)
+            device = os.stat(existing_path).st_dev
+            volume_path, volume_size = volumes.get(device, (existing_path, 0))
+            volumes[device] = (volume_path, volume_size+size)
+        for volume_path, size in volumes.values():
+            free_space = shutil.disk_usage(volume_path).free
+            if free_space < size:
+                log.error("Not enough free space in {}: {} required, {} available".format(volume_path, size, free_space))
+                raise OSError(errno.ENOSPC, "Not enough free space for the update: {} required, {} available".format(utils.convert_bytes(size), utils.convert_bytes(free_space)), volume_path)
+
+    def preallocate_file(self, file: BinaryIO, size: int) -> None:
+        """ Allocates disk space for a file before writing it, which reduces fragmentation and makes a full disk fail before any data is written. Uses :py:func:`os.posix_fallocate` where available, and extends the file otherwise.
+
+        :param file: File opened for writing.
+        :param size: Final size of the file, in bytes.
+        :type size: int
+        """
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(file.fileno(), 0, size)
+                return None
+            except OSError as error:
+                # Some file systems don't support allocation, but a full disk must be reported.
+                if error.errno == errno.ENOSPC:
+                    raise
+        file.truncate(size)
+
+    def extract_update(self, update_archive: str, destination: str, reference_path: Optional[str] = None, file_hashes: Optional[Dict[str, str]] = None) -> str:
         """ Given an update archive, extracts it. Returns the directory to which it has been extracted.
 
+        If reference_path is provided, files in the archive that are identical to the ones in that directory (usually the installed application, as returned by :py:func:`updater.paths.app_path`) are not extracted. As the bootstrapper copies the extracted files over the application, those files keep their current contents, and only the files that differ are written to disk twice. The bootstrapper itself is always extracted. See :py:func:`is_file_unchanged`.
+
         :param update_archive: Path to the update file.
         :type update_archive: str
         :param destination: Path to extract the archive. User must have permission to do file operations on the path.
         :type destination: str
+        :param reference_path: Directory containing the installed version of the files.
+        :type reference_path: str
+        :param file_hashes: Dictionary mapping names in the archive to the sha256 hash of their contents, as written by :py:mod:`updater.builder`. Used to compare files with reference_path.
+        :type file_hashes: dict
         :returns: Path where the archive has been extracted.
         :rtype: str
         """
+        if file_hashes == None:
+            file_hashes = {}
         with contextlib.closing(zipfile.ZipFile(update_archive)) as archive:
             if self.password:
                 archive.setpassword(self.password)
-            archive.extractall(path=destination)
+            if reference_path == None:
+                archive.extractall(path=destination)
+            else:
+                unchanged_files = 0
+                for member in archive.infolist():
+                    if member.filename.endswith("/") or os.path.basename(member.filename) == self.bootstrap_name() or not self.is_file_unchanged(member, cast(str, reference_path), file_hashes.get(member.filename)):
+                        archive.extract(member, path=destination)
+                        continue
+                    # A previous package in the same update might have extracted a different version of this file.
+                    extracted_file = os.path.join(destination, *member.filename.split("/"))
+                    if os.path.isfile(extracted_file):
+                        os.remove(extracted_file)
+                    unchanged_files += 1
+                log.debug("{} unchanged files were not extracted".format(unchanged_files))
         log.debug("Update extracted")
         return destination
 
+    def is_file_unchanged(self, member: zipfile.ZipInfo, reference_path: str, sha256: Optional[str] = None) -> bool:
+        """ Checks whether a file in an update archive is identical to its counterpart in reference_path.
+
+        If the sha256 hash of the file in the archive is known, the files are compared by size and sha256 hash. Otherwise, they are compared by size and the CRC32 checksum which zip files store for every member. CRC32 only detects accidental changes, so two different files of the same size might be taken as identical, and the installed one would be kept. Publish the file hashes generated by :py:mod:`updater.builder` to avoid this.
+
+        :param member: File in the update archive.
+        :type member: :py:class:`zipfile.ZipInfo`
+        :param reference_path: Directory containing the installed version of the file.
+        :type reference_path: str
+        :param sha256: Hash of the file in the archive, as an hexadecimal string.
+        :type sha256: str
+        :rtype: bool
+        """
+        reference_path = os.path.abspath(reference_path)
+        installed_file = os.path.normpath(os.path.join(reference_path, *member.filename.split("/")))
+        if not installed_file.startswith(os.path.join(reference_path, "")) or not os.path.isfile(installed_file):
+            return False
+        if os.path.getsize(installed_file) != member.file_size:
+            return False
+        if sha256 != None:
+            return utils.hash_file(installed_file, chunk_size=1 << 20) == cast(str, sha256).lower()
+        crc = 0
+        with open(installed_file, "rb") as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+        return crc == member.CRC
+
+    def get_file_hashes(self, url: str) -> Optional[Dict[str, str]]:
+        """ Retrieves the sha256 hash of every file in an update package, from the json file written by :py:mod:`updater.builder`. As hashes are only used to skip unchanged files, errors are logged and None is returned.
+
+        :param url: URL of the json file, from the "files" key of a package. See :py:func:`get_update_path`.
+        :type url: str
+        :rtype: dict
+        """
+        try:
+            file_hashes = self.load_update_file(url)
+        except (OSError, ValueError, http.client.HTTPException) as error:
+            log.warning("Unable to retrieve file hashes from {}: {}".format(url, error))
+            return None
+        if not isinstance(file_hashes, dict):
+            log.warning("Invalid file hashes in {}".format(url))
+            return None
+        return file_hashes
+
+    def download_update_path(self, update_path: List[Dict[str, Any]], base_path: str, resume: bool = False, max_rate: Optional[int] = None, reference_path: Optional[str] = None) -> str:
+        """ Downloads all packages returned by :py:func:`get_update_path` and extracts them, in order, into the same directory. Files from later packages replace those from earlier ones, so the result contains every file changed between the current version and the update.
+
+        Packages with a sha256 hash are retrieved from :py:attr:`peer_cache` if possible, and verified and added to it after being downloaded otherwise. This method raises a ValueError if a downloaded package doesn't match its hash.
+
+        :param update_path: Packages to download, as returned by :py:func:`get_update_path`.
+        :type update_path: list
+        :param base_path: Directory where packages will be downloaded and extracted.
+        :type base_path: str
+        :param resume: Whether to resume interrupted downloads. See :py:func:`download_update`.
+        :type resume: bool
+        :param max_rate: Maximum download speed, in bytes per second. See :py:func:`download_update`.
+        :type max_rate: int
+        :param reference_path: Directory with the installed application. Files that are identical in the update are not extracted, comparing them by the hashes in the "files" key of each package, if present. See :py:func:`extract_update`.
+        :type reference_path: str
+        :returns: Path where the update has been extracted.
+        :rtype: str
+        """
+        download_paths = []
+        package_hashes: List[Optional[Dict[str, str]]] = []
+        extraction_path = os.path.join(base_path, "update")
+        for index, package in enumerate(update_path):
+            download_path = os.path.join(base_path, "update-{}.zip".format(index))
+            package_hashes.append(self.get_file_hashes(package["files"]) if reference_path != None and package.get("files") != None else None)
+            sha256 = package.get("sha256")
+            if sha256 != None and self.peer_cache != None:
+                if package.get("size") != None:
+                    self.check_free_space({download_path: package["size"], extraction_path: package.get("extracted_size") or 0})
+                if self.peer_cache.fetch(sha256, download_path, size=package.get("size")):
+                    download_paths.append(download_path)
+                    continue
+            download_path = self.download_update(package["url"], download_path, resume=resume, max_rate=max_rate, extracted_size=package.get("extracted_size"), extraction_path=extraction_path)
+            if sha256 != None:
+                self.verify_download(download_path, sha256)
+                if self.peer_cache != None:
+                    try:
+                        self.peer_cache.add(download_path, sha256)
+                    except OSError as error:
+                        # Sharing updates with peers is optional.
+                        log.warning("Unable to add {} to the peer cache: {}".format(download_path, error))
+            download_paths.append(download_path)
+        shutil.rmtree(extraction_path, ignore_errors=True)
+        for download_path, file_hashes in zip(download_paths, package_hashes):
+            extraction_path = self.extract_update(download_path, destination=extraction_path, reference_path=reference_path, file_hashes=file_hashes)
+            os.remove(download_path)
+        return extraction_path
+
+    def verify_download(self, download_path: str, sha256: str) -> None:
+        """ Checks that a downloaded package matches its sha256 hash. If it doesn't, the package is removed, so it is downloaded again from scratch, and a ValueError is raised.
+
+        :param download_path: Path to the downloaded package.
+        :type download_path: str
+        :param sha256: Expected sha256 hash, as published in the update file.
+        :type sha256: str
+        """
+        file_hash = utils.hash_file(download_path)
+        if file_hash == sha256.lower():
+            return None
+        log.error("Downloaded update {} doesn't match its sha256 hash: expected {}, got {}".format(download_path, sha256, file_hash))
+        for path in (download_path, download_path+".progress"):
+            if os.path.exists(path):
+                os.remove(path)
+        raise ValueError("Downloaded update doesn't match its sha256 hash.")
+
+    def stage_update(self, update_path: List[Dict[str, Any]], update_version: str, max_rate: Optional[int] = None, reference_path: Optional[str] = None) -> str:
+        """ Downloads and extracts an update into a persistent staging directory inside :py:attr:`data_directory`, so it can be installed later without waiting for the download.
+
+        Downloads are resumed if a previous call was interrupted, and an update that has already been staged is not downloaded again. Updates staged for other versions are removed.
+
+        :param update_path: Packages to download, as returned by :py:func:`get_update_path`.
+        :type update_path: list
+        :param update_version: Version of the update being staged.
+        :type update_version: str
+        :param max_rate: Maximum download speed, in bytes per second. See :py:func:`download_update`.
+        :type max_rate: int
+        :param reference_path: Directory with the installed application. See :py:func:`extract_update`.
+        :type reference_path: str
+        :returns: Path where the update has been extracted, as returned by :py:func:`download_update_path`.
+        :rtype: str
+        """
+        updates_directory = os.path.join(self.data_directory, "updates")
+        staging_path = os.path.join(updates_directory, update_version)
+        if os.path.isdir(updates_directory):
+            for name in os.listdir(updates_directory):
+                if name != update_version:
+                    shutil.rmtree(os.path.join(updates_directory, name), ignore_errors=True)
+        urls_path = os.path.join(staging_path, "packages.json")
+        marker_path = os.path.join(staging_path, "staged")
+        extraction_path = os.path.join(staging_path, "update")
+        update_urls = json.dumps([package["url"] for package in update_path])
+        staged_urls = None
+        if os.path.exists(urls_path):
+            with open(urls_path, "r") as f:
+                staged_urls = f.read()
+        if staged_urls != update_urls:
+            # Partial downloads from other packages can't be resumed.
+            shutil.rmtree(staging_path, ignore_errors=True)
+        elif os.path.exists(marker_path) and os.path.isdir(extraction_path):
+            log.debug("Update {} is already staged".format(update_version))
+            return extraction_path
+        os.makedirs(staging_path, exist_ok=True)
+        with open(urls_path, "w") as f:
+            f.write(update_urls)
+        extraction_path = self.download_update_path(update_path, staging_path, resume=True, max_rate=max_rate, reference_path=reference_path)
+        with open(marker_path, "w") as f:
+            f.write(update_version)
+        log.debug("Update {} staged".format(update_version))
+        return extraction_path
+
     def move_bootstrap(self, extracted_path: str) -> str:
         """ Moves the bootstrapper binary from the update extraction folder to a working path, so it will be able to perform operations under the update directory later.
 
+        Staged updates (see :py:func:`stage_update`) are reused, so the bootstrapper might have been moved already by an earlier attempt to install the same update. In that case, the bootstrapper moved before is returned.
+
         :param extracted_path: Path to which the update file has been extracted.
         :type extracted_path: str
         :returns: The path to the bootstrap binary to be run to actually perform the update.
@@ -143,26 +859,193 @@ class UpdaterCore(object):
             extracted_path = os.path.join(extracted_path, 'Contents', 'Resources')
         downloaded_bootstrap = os.path.join(extracted_path, self.bootstrap_name())
         new_bootstrap_path = os.path.join(working_path, self.bootstrap_name())
-        os.rename(downloaded_bootstrap, new_bootstrap_path)
+        if os.path.lexists(downloaded_bootstrap) == False and os.path.exists(new_bootstrap_path):
+            log.debug("Bootstrapper already moved to {}".format(new_bootstrap_path))
+            return new_bootstrap_path
+        os.replace(downloaded_bootstrap, new_bootstrap_path)
         return new_bootstrap_path
 
     def execute_bootstrap(self, bootstrap_path: str, source_path: str) -> None:
         """ Executes the bootstrapper binary, which will move the files from the update directory to the app folder, finishing with the update process.
 
+        If :py:attr:`snapshot_retention` is set, a snapshot of the current version is taken first, and the rollback watchdog is started once the bootstrapper is running if :py:attr:`health_timeout` is set too. If the bootstrapper can't be started, for example because the user declined to run it with elevated permissions, the snapshot is restored and the error is raised again.
+
         :param bootstrap_path: Path to the bootstrap binary that will perform the update, as returned by :py:func:`move_bootstrap`
         :type bootstrap_path: str
         :param source_path: Path where the update file was extracted, as returned by :py:func:`extract_update`
         :type source_path: str
         """
-        arguments = r'"%s" "%s" "%s" "%s"' % (os.getpid(), source_path, paths.app_path(), paths.get_executable())
-        if platform.system() == 'Windows':
-            import win32api # type: ignore
-            win32api.ShellExecute(0, 'open', bootstrap_path, arguments, '', 5)
+        if self.snapshot_retention > 0:
+            self.create_snapshot(source_path)
+        arguments = r'"%s" "%s" "%s" "%s"' % (os.getpid(), source_path, self.get_app_path(), self.get_executable())
+        try:
+            if platform.system() == 'Windows':
+                import win32api # type: ignore
+                win32api.ShellExecute(0, 'open', bootstrap_path, arguments, '', 5)
+            else:
+                import subprocess
+                self.make_executable(bootstrap_path)
+                subprocess.Popen(['%s %s' % (bootstrap_path, arguments)], shell=True)
+        except Exception:
+            if self.snapshot_retention > 0:
+                # Files replaced by the update have already been moved into the snapshot.
+                log.exception("Unable to execute the bootstrapper, restoring version {}".format(self.current_version))
+                self.rollback(relaunch=False)
+            raise
+        if self.snapshot_retention > 0 and self.health_timeout != None:
+            self.start_watchdog()
+        log.info("Bootstrap executed")
+
+    def create_snapshot(self, source_path: str) -> str:
+        """ Keeps a copy of the installed application in :py:attr:`snapshot_directory`, so it can be restored by :py:func:`rollback` if the update fails.
+
+        No data is copied. Files the update doesn't touch are hard linked into the snapshot. Files the update replaces are moved there, so the bootstrapper writes new files instead of overwriting the ones in the snapshot. Data is only copied if the snapshot directory is in another volume, or the file system doesn't support hard links.
+
+        Only the newest :py:attr:`snapshot_retention` snapshots are kept. They are listed, from oldest to newest, in the "snapshots" entry of the state file, so :py:func:`rollback` can restore any of them.
+
+        :param source_path: Path where the update has been extracted.
+        :type source_path: str
+        :returns: Path to the snapshot.
+        :rtype: str
+        """
+        app_path = self.get_app_path()
+        snapshot_path = os.path.join(self.snapshot_directory, self.current_version)
+        shutil.rmtree(snapshot_path, ignore_errors=True)
+        for root, directories, files in os.walk(app_path):
+            # Data directory might live inside portable applications.
+            directories[:] = [d for d in directories if os.path.abspath(os.path.join(root, d)) != os.path.abspath(self.data_directory)]
+            relative_root = os.path.relpath(root, app_path)
+            snapshot_root = os.path.normpath(os.path.join(snapshot_path, relative_root))
+            os.makedirs(snapshot_root, exist_ok=True)
+            for name in files:
+                installed_file = os.path.join(root, name)
+                snapshot_file = os.path.join(snapshot_root, name)
+                try:
+                    if os.path.lexists(os.path.join(source_path, relative_root, name)):
+                        os.rename(installed_file, snapshot_file)
+                    else:
+                        os.link(installed_file, snapshot_file)
+                except OSError:
+                    log.warning("Unable to link {} into snapshot, copying it instead".format(installed_file))
+                    shutil.copy2(installed_file, snapshot_file)
+        command = [self.get_executable()]
+        if self.executable == None and paths.is_frozen() == False:
+            command.insert(0, sys.executable)
+        with self.update_state() as state:
+            snapshots = [snapshot for snapshot in state.get("snapshots", []) if snapshot.get("version") != self.current_version]
+            snapshots.append(dict(version=self.current_version, snapshot=snapshot_path, app_path=app_path, command=command))
+            while len(snapshots) > max(self.snapshot_retention, 1):
+                shutil.rmtree(snapshots.pop(0)["snapshot"], ignore_errors=True)
+            kept_paths = [os.path.abspath(snapshot["snapshot"]) for snapshot in snapshots]
+            for name in os.listdir(self.snapshot_directory):
+                if os.path.abspath(os.path.join(self.snapshot_directory, name)) not in kept_paths:
+                    shutil.rmtree(os.path.join(self.snapshot_directory, name), ignore_errors=True)
+            state["snapshots"] = snapshots
+            state["install"] = dict(previous_version=self.current_version, version=self.update_version, snapshot=snapshot_path, app_path=app_path, command=command, installed_at=time.time(), health_timeout=self.health_timeout, healthy=False)
+        log.debug("Snapshot of version {} created at {}".format(self.current_version, snapshot_path))
+        return snapshot_path
+
+    def start_watchdog(self) -> None:
+        """ Starts a detached process that restores the previous version if the new one doesn't call :py:func:`mark_healthy` within :py:attr:`health_timeout` seconds. See :py:mod:`updater.rollback`.
+
+        In frozen applications there is no Python interpreter to run the watchdog, so the executable of the previous version, kept in the snapshot, is started with :py:data:`updater.rollback.watchdog_argument` instead. This only happens if the application has called :py:func:`updater.rollback.handle_watchdog_command` at startup; otherwise, the application would just be started again, so no watchdog is run and the application should call :py:func:`check_install_health` at startup instead.
+        """
+        import subprocess
+        state_file = os.path.abspath(self.state_file)
+        if paths.is_frozen():
+            from . import rollback
+            if rollback.watchdog_command_handled == False:
+                log.warning("Rollback watchdog is not available, as the application doesn't call updater.rollback.handle_watchdog_command.")
+                return None
+            # The installed executable is about to be replaced by the new version, which might be the broken one.
+            install = self.load_state().get("install", {})
+            executable = os.path.join(install.get("snapshot", ""), os.path.relpath(sys.executable, install.get("app_path", "")))
+            if os.path.isfile(executable) == False:
+                executable = sys.executable
+            command = [executable, rollback.watchdog_argument, "--state-file", state_file, "watch"]
+            working_directory = self.data_directory
+        else:
+            command = [sys.executable, "-m", "updater.rollback", "--state-file", state_file, "watch"]
+            # Run from the directory containing the updater package, so it can be imported even if it is bundled with the application rather than installed.
+            working_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if platform.system() == "Windows":
+            flags = getattr(subprocess, "DETACHED_PROCESS", 0) | getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0)
+            subprocess.Popen(command, cwd=working_directory, creationflags=flags, close_fds=True)
         else:
+            subprocess.Popen(command, cwd=working_directory, start_new_session=True, close_fds=True)
+        log.debug("Rollback watchdog started")
+
+    def mark_healthy(self) -> None:
+        """ Confirms that the installed update works. Applications should call this function once they have started successfully after an update, otherwise it is rolled back when :py:attr:`health_timeout` expires. """
+        with self.update_state() as state:
+            install = state.get("install")
+            if isinstance(install, dict) and install.get("healthy") == False:
+                install["healthy"] = True
+                log.debug("Update marked as healthy")
+
+    def check_install_health(self, relaunch: bool = True) -> bool:
+        """ Rolls back the last update if its health timeout has expired without a call to :py:func:`mark_healthy`. Applications that can't rely on the watchdog process might call this function at startup.
+
+        :param relaunch: Whether to start the restored version after rolling back.
+        :type relaunch: bool
+        :returns: False if the update has been rolled back, in which case the application should exit. True otherwise.
+        :rtype: bool
+        """
+        # The lock is held until the rollback finishes, so a late call to mark_healthy can't be lost.
+        with self.lock_state():
+            install = self.load_state().get("install")
+            if not isinstance(install, dict) or install.get("healthy") != False or install.get("health_timeout") == None:
+                return True
+            if time.time() < install["installed_at"]+install["health_timeout"]:
+                return True
+            log.warning("Update to {} was not marked as healthy in time".format(install.get("version")))
+            return not self.rollback(relaunch=relaunch)
+
+    def get_snapshots(self) -> List[Dict[str, Any]]:
+        """ Returns the snapshots kept by :py:func:`create_snapshot`, from oldest to newest. Every snapshot is a dictionary with the keys "version", "snapshot" (its path), "app_path" and "command" (the command that starts that version).
+
+        :rtype: list
+        """
+        return [snapshot for snapshot in self.load_state().get("snapshots", []) if os.path.isdir(snapshot.get("snapshot", ""))]
+
+    def rollback(self, relaunch: bool = True, version: Optional[str] = None) -> bool:
+        """ Restores a version that was installed before, from a snapshot taken by :py:func:`create_snapshot`. By default, the version installed before the last update is restored. As the restored snapshot is consumed, calling this function again restores the version installed before that one, if its snapshot has been kept.
+
+        The contents of the application directory are replaced by moving entries, so when the snapshot is in the same volume only a few renames are needed.
+
+        :param relaunch: Whether to start the restored version. The caller should exit afterwards.
+        :type relaunch: bool
+        :param version: Version to restore. See :py:func:`get_snapshots`.
+        :type version: str
+        :returns: True if the version has been restored, False if there is no snapshot to restore.
+        :rtype: bool
+        """
+        # Another process might be rolling back too, such as the watchdog and the updater-rollback command.
+        with self.lock_state():
+            snapshots = [snapshot for snapshot in self.get_snapshots() if version == None or snapshot["version"] == version]
+            if snapshots == []:
+                log.error("There is no snapshot to roll back to.")
+                return False
+            restored = snapshots[-1]
+            snapshot_path = restored["snapshot"]
+            app_path = restored["app_path"]
+            failed_path = os.path.join(os.path.dirname(snapshot_path), ".failed-{}".format(int(time.time())))
+            os.makedirs(failed_path)
+            for name in os.listdir(app_path):
+                shutil.move(os.path.join(app_path, name), os.path.join(failed_path, name))
+            for name in os.listdir(snapshot_path):
+                shutil.move(os.path.join(snapshot_path, name), os.path.join(app_path, name))
+            os.rmdir(snapshot_path)
+            shutil.rmtree(failed_path, ignore_errors=True)
+            with self.update_state() as state:
+                state["snapshots"] = [snapshot for snapshot in state.get("snapshots", []) if snapshot.get("snapshot") != snapshot_path]
+                # The health check of the last update doesn't apply to the restored version.
+                state.pop("install", None)
+        log.info("Rolled back to version {}".format(restored["version"]))
+        if relaunch:
             import subprocess
-            self.make_executable(bootstrap_path)
-            subprocess.Popen(['%s %s' % (bootstrap_path, arguments)], shell=True)
-        log.info("Bootstrap executed")
+            subprocess.Popen(restored["command"], cwd=app_path)
+        return True
 
     def bootstrap_name(self) -> str:
         """ Returns the name of the bootstrapper, based in user platform.
@@ -57,4 +57,19 @@ def app_path() -> str:
     path = executable_directory()
     if is_frozen() and is_mac:
         path = os.path.abspath(os.path.join(path, "..", ".."))
-    return path
\ No newline at end of file
+    return path
+
+def data_path(app_name: str) -> str:
+    """ Returns the per-user directory where the updater can keep its own state for an application. The directory is not created by this function.
+
+    :param app_name: Name of the application. It is used as the last component of the returned path.
+    :type app_name: str
+    :rtype: str
+    """
+    if is_windows:
+        base = os.environ.get("APPDATA") or os.path.expanduser(os.path.join("~", "AppData", "Roaming"))
+    elif is_mac:
+        base = os.path.expanduser(os.path.join("~", "Library", "Application Support"))
+    else:
+        base = os.environ.get("XDG_DATA_HOME") or os.path.expanduser(os.path.join("~", ".local", "share"))
+    return os.path.join(base, app_name)
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+""" Share update files between computers in the same local network.
+
+When many computers in an office download the same update, each of them retrieves the whole file from the internet. By using a :py:class:`PeerCache`, computers that already have a verified update file serve it over a small HTTP server, and other computers try to download it from them before falling back to the URL in the update file. Every file is identified and verified by its sha256 hash, so a peer can't send anything other than the file published in the update information.
+
+Peers can be configured by a list of URLs, discovered via multicast in the local network, or both:
+
+    >>> from updater import peercache
+    >>> from updater.wxupdater import WXUpdater
+    >>> cache = peercache.PeerCache("/path/to/cache", peers=["http://192.168.1.10:8765"], discovery=True)
+    >>> cache.serve()
+    >>> updater = WXUpdater(app_name="My app", current_version="0.1", endpoint="https://some_url.com", peer_cache=cache)
+    >>> updater.check_for_updates()
+
+:note:
+    Peers are only used for files with a sha256 hash in the update information, as the updater-build command generates.
+
+A dedicated cache can also be run from the command line, for example in a server of the local network, either via the updater-peercache command or by running the module directly:
+
+.. code-block:: bash
+
+    python -m updater.peercache --cache-dir /srv/updates add update-1.1-Windows64.zip
+    python -m updater.peercache --cache-dir /srv/updates serve --port 8765 --discovery
+"""
+import argparse
+import http.server
+import io
+import logging
+import os
+import re
+import shutil
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import urllib.request
+from typing import Any, List, Optional
+from . import utils
+
+log = logging.getLogger("updater.peercache")
+
+multicast_group: str = "239.255.77.77"
+discovery_port: int = 8766
+
+class PeerRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves files stored in a :py:class:`PeerCache`. Files are requested by their sha256 hash, as in GET /<sha256>. """
+
+    server: "PeerServer"
+
+    def do_GET(self) -> None:
+        sha256 = self.path.strip("/").lower()
+        if not self.server.peer_cache.has(sha256):
+            self.send_error(404)
+            return None
+        path = self.server.peer_cache.path(sha256)
+        with open(path, "rb") as f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        log.debug("%s - %s" % (self.address_string(), format % args))
+
+class PeerServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ HTTP server for a :py:class:`PeerCache`. """
+
+    daemon_threads = True
+
+    def __init__(self, address: Any, peer_cache: "PeerCache") -> None:
+        self.peer_cache = peer_cache
+        super(PeerServer, self).__init__(address, PeerRequestHandler)
+
+class PeerCache(object):
+    """ Local cache of verified update files, which is shared with, and retrieved from, other computers in the local network. """
+
+    def __init__(self, cache_directory: str, peers: Optional[List[str]] = None, discovery: bool = False, port: int = 8765, max_files: int = 3, timeout: float = 5, discovery_timeout: float = 1) -> None:
+        """
+        :param cache_directory: Directory where update files are stored. It is created if needed.
+        :type cache_directory: str
+        :param peers: URLs of peers to try before the origin URL, for example "http://192.168.1.10:8765".
+        :type peers: list
+        :param discovery: Whether to look for peers via multicast, and to answer other peers looking for files when serving.
+        :type discovery: bool
+        :param port: TCP port where :py:func:`serve` listens. Use 0 to select a free port.
+            (default is 8765)
+        :type port: int
+        :param max_files: Number of update files to keep in the cache. Older ones are removed.
+            (default is 3)
+        :type max_files: int
+        :param timeout: Timeout, in seconds, for connections to peers.
+        :type timeout: float
+        :param discovery_timeout: Seconds to wait for answers to a multicast discovery.
+        :type discovery_timeout: float
+        """
+        self.cache_directory = cache_directory
+        self.peers = peers or []
+        self.discovery = discovery
+        self.port = port
+        self.max_files = max_files
+        self.timeout = timeout
+        self.discovery_timeout = discovery_timeout
+        self.server: Optional[PeerServer] = None
+        self.discovery_socket: Optional[socket.socket] = None
+
+    def path(self, sha256: str) -> str:
+        """ Returns the path where the file with the given hash is stored in the cache.
+
+        :rtype: str
+        """
+        return os.path.join(self.cache_directory, sha256.lower())
+
+    def has(self, sha256: str) -> bool:
+        """ Checks whether the cache contains the file with the given hash.
+
+        :rtype: bool
+        """
+        return re.match(r"^[0-9a-fA-F]{64}$", sha256) != None and os.path.isfile(self.path(sha256))
+
+    def add(self, path: str, sha256: str) -> None:
+        """ Adds a file, which must already be verified against sha256, to the cache. The file is hard linked if possible, and copied otherwise.
+
+        Old files that can't be removed from the cache, for example because they are being sent to a peer, are left for the next call.
+
+        :param path: Path to the file.
+        :type path: str
+        :param sha256: sha256 hash of the file.
+        :type sha256: str
+        :raises: :py:exc:`OSError` if the file can't be written to the cache.
+        """
+        if self.has(sha256):
+            return None
+        os.makedirs(self.cache_directory, exist_ok=True)
+        temp_path = self.path(sha256)+".tmp"
+        try:
+            try:
+                os.link(path, temp_path)
+            except OSError:
+                shutil.copyfile(path, temp_path)
+            os.replace(temp_path, self.path(sha256))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        log.debug("Added {} to the peer cache".format(sha256))
+        files = [name for name in os.listdir(self.cache_directory) if self.has(name)]
+        files.sort(key=lambda name: os.path.getmtime(self.path(name)), reverse=True)
+        for name in files[self.max_files:]:
+            try:
+                os.remove(self.path(name))
+            except OSError as error:
+                log.warning("Unable to remove {} from the peer cache: {}".format(name, error))
+
+    def serve(self) -> int:
+        """ Starts serving the files in the cache to other peers, in background threads. If discovery is enabled, multicast queries from other peers are answered too.
+
+        :returns: TCP port where files are served.
+        :rtype: int
+        """
+        self.server = PeerServer(("", self.port), self)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        port = self.server.server_address[1]
+        if self.discovery:
+            self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.discovery_socket.bind(("", discovery_port))
+            membership = struct.pack("4sl", socket.inet_aton(multicast_group), socket.INADDR_ANY)
+            self.discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            threading.Thread(target=self.answer_discovery, args=(self.discovery_socket, port), daemon=True).start()
+        log.info("Serving peer cache on port {}".format(port))
+        return port
+
+    def answer_discovery(self, discovery_socket: socket.socket, port: int) -> None:
+        """ Answers multicast queries from peers looking for a file, if it is in the cache. This runs in a thread started by :py:func:`serve`. """
+        while True:
+            try:
+                data, address = discovery_socket.recvfrom(1024)
+            except OSError:
+                # Socket closed by stop().
+                return None
+            message = data.decode("ascii", "ignore").split()
+            if len(message) == 2 and message[0] == "UPDATER-WHO-HAS" and self.has(message[1]):
+                discovery_socket.sendto("UPDATER-HAS {} {}".format(message[1], port).encode("ascii"), address)
+
+    def stop(self) -> None:
+        """ Stops serving files. """
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.discovery_socket != None:
+            self.discovery_socket.close()
+            self.discovery_socket = None
+
+    def discover(self, sha256: str) -> List[str]:
+        """ Looks for peers that have the file with the given hash, via multicast.
+
+        :returns: URLs of the peers that answered in time.
+        :rtype: list
+        """
+        peers: List[str] = []
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as query_socket:
+            query_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            try:
+                query_socket.sendto("UPDATER-WHO-HAS {}".format(sha256).encode("ascii"), (multicast_group, discovery_port))
+            except OSError:
+                log.exception("Unable to send peer discovery query")
+                return peers
+            deadline = time.monotonic()+self.discovery_timeout
+            while True:
+                remaining = deadline-time.monotonic()
+                if remaining <= 0:
+                    break
+                query_socket.settimeout(remaining)
+                try:
+                    data, address = query_socket.recvfrom(1024)
+                except socket.timeout:
+                    break
+                message = data.decode("ascii", "ignore").split()
+                if len(message) == 3 and message[0] == "UPDATER-HAS" and message[1] == sha256 and message[2].isdigit():
+                    peers.append("http://{}:{}".format(address[0], message[2]))
+        log.debug("Discovered peers for {}: {}".format(sha256, peers))
+        return peers
+
+    def fetch(self, sha256: str, destination: str, size: Optional[int] = None) -> bool:
+        """ Retrieves the file with the given hash from the local cache or from a peer, and saves it at destination. Peers sending an invalid file, or more data than expected, are skipped.
+
+        :param sha256: sha256 hash of the file.
+        :type sha256: str
+        :param destination: Path where the file will be saved.
+        :type destination: str
+        :param size: Size of the file, in bytes, if known. Peers reporting a different size are skipped. Otherwise, peers are trusted to send as much data as their Content-Length header reports, and no more.
+        :type size: int
+        :returns: True if the file has been retrieved, False if no peer has it and it must be downloaded from the origin URL.
+        :rtype: bool
+        """
+        if self.has(sha256):
+            shutil.copyfile(self.path(sha256), destination)
+            log.debug("Update {} found in the local peer cache".format(sha256))
+            return True
+        peers = list(self.peers)
+        if self.discovery:
+            peers.extend(peer for peer in self.discover(sha256) if peer not in peers)
+        # Partial downloads at destination must be kept, in case the file is downloaded from the origin later.
+        temp_path = destination+".peer"
+        for peer in peers:
+            url = "{}/{}".format(peer.rstrip("/"), sha256)
+            try:
+                with urllib.request.urlopen(url, timeout=self.timeout) as response, open(temp_path, "wb") as f:
+                    self.receive(response, f, size)
+            except (OSError, ValueError) as error:
+                log.debug("Unable to retrieve {} from peer {}: {}".format(sha256, peer, error))
+                continue
+            if utils.hash_file(temp_path) == sha256.lower():
+                log.info("Update {} retrieved from peer {}".format(sha256, peer))
+                os.replace(temp_path, destination)
+                try:
+                    self.add(destination, sha256)
+                except OSError as error:
+                    log.warning("Unable to add {} to the peer cache: {}".format(sha256, error))
+                return True
+            log.warning("Peer {} sent an invalid file for {}".format(peer, sha256))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+    def receive(self, response: Any, file: Any, size: Optional[int] = None) -> None:
+        """ Writes the body of a response from a peer to a file, without writing more data than expected, so peers can't fill the disk.
+
+        :param response: Response from the peer.
+        :param file: File opened for writing.
+        :param size: Expected size, in bytes, if known.
+        :raises: :py:exc:`ValueError` if the peer reports a different size than expected, doesn't report any, or sends more data.
+        """
+        content_length = response.headers.get("Content-Length")
+        if content_length != None:
+            content_length = int(content_length)
+            if size != None and content_length != size:
+                raise ValueError("Peer reported {} bytes, {} expected".format(content_length, size))
+        limit = size if size != None else content_length
+        if limit == None:
+            raise ValueError("Peer didn't report the size of the file")
+        received = 0
+        while True:
+            chunk = response.read(io.DEFAULT_BUFFER_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            if received > limit:
+                raise ValueError("Peer sent more than {} bytes".format(limit))
+            file.write(chunk)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """ Entry point for the updater-peercache command.
+
+    :returns: Process exit code.
+    :rtype: int
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(prog="updater-peercache", description="Shares update files with other computers in the local network.")
+    parser.add_argument("--cache-dir", required=True, help="Directory where update files are stored.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    serve_command = commands.add_parser("serve", help="Serve the files in the cache.")
+    serve_command.add_argument("--port", type=int, default=8765, help="TCP port to listen on. Use 0 to select a free port.")
+    serve_command.add_argument("--discovery", action="store_true", help="Answer multicast queries from peers.")
+    add_command = commands.add_parser("add", help="Add update files to the cache.")
+    add_command.add_argument("files", nargs="+")
+    arguments = parser.parse_args(argv)
+    if arguments.command == "add":
+        cache = PeerCache(arguments.cache_dir, max_files=sys.maxsize)
+        for path in arguments.files:
+            cache.add(path, utils.hash_file(path))
+        return 0
+    cache = PeerCache(arguments.cache_dir, discovery=arguments.discovery, port=arguments.port)
+    port = cache.serve()
+    print("Serving on port {}".format(port), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        cache.stop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
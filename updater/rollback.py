@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+""" Command line interface to roll back updates.
+
+Updates can be rolled back when the updater keeps snapshots of previous versions (see the snapshot_retention parameter of :py:class:`updater.core.UpdaterCore`). This module provides two commands, which work on the state file of the updater, so they don't need to know anything else about the application:
+
+* restore: restores the version installed before the last update and starts it. Older versions, if their snapshots have been kept, can be restored with --version.
+* list: lists the versions that can be restored.
+* watch: waits until the health timeout of the last update expires, and restores the previous version if the new one has not called :py:func:`updater.core.UpdaterCore.mark_healthy`. This is the command run by :py:func:`updater.core.UpdaterCore.start_watchdog`.
+
+They can be run via the updater-rollback command or by running the module directly:
+
+.. code-block:: bash
+
+    python -m updater.rollback --app-name "My app" restore
+
+Frozen applications have no Python interpreter to run this module, so the watchdog is started by running the application executable itself with :py:data:`watchdog_argument`. Those applications must call :py:func:`handle_watchdog_command` as the first thing they do at startup, which also tells the updater that the watchdog is supported.
+"""
+import argparse
+import logging
+import sys
+import time
+from typing import List, Optional
+from . import core
+
+log = logging.getLogger("updater.rollback")
+
+watchdog_argument: str = "--updater-watchdog"
+""" First command line argument of the application executable when it is started as the rollback watchdog. """
+watchdog_command_handled: bool = False
+""" Set by :py:func:`handle_watchdog_command`, so :py:func:`updater.core.UpdaterCore.start_watchdog` knows that a frozen application can run the watchdog. """
+
+def handle_watchdog_command(argv: Optional[List[str]] = None) -> None:
+    """ Runs the rollback command and exits if the application has been started as the rollback watchdog, and returns otherwise. Frozen applications using a health timeout must call this function before doing anything else at startup, like this:
+
+    .. code-block:: python
+
+        if __name__ == "__main__":
+            updater.rollback.handle_watchdog_command()
+            start_application()
+
+    :param argv: Command line of the application. Defaults to sys.argv.
+    :type argv: list
+    """
+    global watchdog_command_handled
+    if argv == None:
+        argv = sys.argv
+    if len(argv) > 1 and argv[1] == watchdog_argument:
+        sys.exit(main(argv[2:]))
+    watchdog_command_handled = True
+
+def watch(updater: core.UpdaterCore, relaunch: bool = True, poll_interval: float = 1) -> int:
+    """ Waits for the last installed update to be marked as healthy, and rolls it back otherwise.
+
+    :param updater: Updater instance using the application's state file.
+    :type updater: :py:class:`updater.core.UpdaterCore`
+    :param relaunch: Whether to start the restored version after rolling back.
+    :type relaunch: bool
+    :param poll_interval: Seconds to wait between checks of the state file.
+    :type poll_interval: float
+    :returns: 0 if the update has been marked as healthy, 2 if it has been rolled back and 1 on errors.
+    :rtype: int
+    """
+    while True:
+        install = updater.load_state().get("install")
+        if not isinstance(install, dict) or install.get("health_timeout") == None:
+            log.error("There is no update waiting for a health check.")
+            return 1
+        if install.get("healthy"):
+            log.info("Update to {} marked as healthy".format(install.get("version")))
+            return 0
+        if updater.check_install_health(relaunch=relaunch) == False:
+            return 2
+        time.sleep(poll_interval)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """ Entry point for the updater-rollback command.
+
+    :returns: Process exit code.
+    :rtype: int
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(prog="updater-rollback", description="Restores the previous version of an application after a failed update.")
+    location = parser.add_mutually_exclusive_group(required=True)
+    location.add_argument("--state-file", help="Path to the state file of the updater.")
+    location.add_argument("--app-name", help="Name of the application, as passed to the updater. Used to find the default state file.")
+    parser.add_argument("--no-relaunch", action="store_true", help="Don't start the application after restoring it.")
+    parser.add_argument("--version", default=None, help="Version to restore. Defaults to the version installed before the last update.")
+    parser.add_argument("command", choices=["restore", "watch", "list"])
+    arguments = parser.parse_args(argv)
+    updater = core.UpdaterCore(endpoint="", current_version="", app_name=arguments.app_name or "", state_file=arguments.state_file)
+    if arguments.command == "watch":
+        return watch(updater, relaunch=not arguments.no_relaunch)
+    if arguments.command == "list":
+        for snapshot in updater.get_snapshots():
+            print(snapshot["version"])
+        return 0
+    if updater.rollback(relaunch=not arguments.no_relaunch, version=arguments.version):
+        return 0
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
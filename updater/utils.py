@@ -1,4 +1,14 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import io
+import platform
+
+def get_platform_key() -> str:
+    """ Returns the key used in the downloads section of update files for the current platform. This is the result of :py:func:`platform.system` plus the first two characters of the architecture reported by :py:func:`platform.architecture`, for example "Windows64".
+
+    :rtype: str
+    """
+    return platform.system()+platform.architecture()[0][:2]
 
 def convert_bytes(n: float) -> str:
     """ Converts a value expressed in bytes to a human readable String.
@@ -20,3 +30,19 @@ def convert_bytes(n: float) -> str:
         return "%.2fKb" % (float(n) / K)
     else:
         return "%d" % n
+
+def hash_file(path: str, chunk_size: int = io.DEFAULT_BUFFER_SIZE) -> str:
+    """ Returns the sha256 hash of a file, as an hexadecimal string.
+
+    :param path: Path to the file.
+    :type path: str
+    :rtype: str
+    """
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
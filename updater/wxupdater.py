@@ -25,20 +25,26 @@ Also, you can customize messages in the update dialogs via the parameters :py:da
     >>> updater.new_update_msg = "Do you want to get it right now?"
     >>> updater.check_for_updates()
     >>> app.MainLoop()
+
+If you prefer users not to wait for the download, pass prefetch=True. The update is then downloaded and extracted in a background thread, and users are asked to install it only once it is ready,
+
+    >>> updater = WXUpdater(app_name="My app", current_version="0.1", endpoint="https://some_url.com", prefetch=True, prefetch_rate=512*1024)
+    >>> updater.check_for_updates()
 """
 
 import os
 import tempfile
+import threading
 try:
     import wx # type: ignore
     wx_present = True
 except ImportError:
     wx_present = False
 import logging
-from typing import Optional, Any, cast
+from typing import Optional, Any, Dict, List, cast
 from pubsub import pub # type: ignore
 from pubsub.core.topicexc import TopicNameError # type: ignore
-from . import core, utils, paths
+from . import core, utils
 
 log = logging.getLogger("updater.WXUpdater")
 
@@ -51,6 +57,9 @@ class WXUpdater(core.UpdaterCore):
     :ivar update_progress_msg: Text to display while update is downloading. Available variables are {total_downloaded} and {total_size}, which are human readable strings of data downloaded.
     :ivar update_almost_complete_title: Title of the message to display to users when the update is about to be installed.
     :ivar update_almost_complete_msg: Message to explain to users about the application restart, after updates are applied.
+    :ivar prefetch: Whether updates are downloaded and extracted in the background before asking users to install them.
+    :ivar prefetch_rate: Maximum download speed, in bytes per second, used when prefetching updates. None means no limit.
+    :ivar prefetch_thread: Thread staging the update when prefetching, if any. Checks for updates made while it runs don't start another one.
     """
 
     new_update_title: str = "New version for {app_name}"
@@ -59,8 +68,10 @@ class WXUpdater(core.UpdaterCore):
     update_progress_msg: str = "Updating... {total_downloaded} of {total_size}"
     update_almost_complete_title: str = "Done"
     update_almost_complete_msg: str = "The update is about to be installed in your system. After being installed, the application will restart. Press OK to continue."
+    prefetch: bool = False
+    prefetch_rate: Optional[int] = None
 
-    def __init__(self, new_update_title: Optional[str] = None, new_update_msg: Optional[str] = None, update_progress_title: Optional[str] = None, update_progress_msg: Optional[str] = None, update_almost_complete_title: Optional[str] = None, update_almost_complete_msg: Optional[str] = None, *args, **kwargs):
+    def __init__(self, new_update_title: Optional[str] = None, new_update_msg: Optional[str] = None, update_progress_title: Optional[str] = None, update_progress_msg: Optional[str] = None, update_almost_complete_title: Optional[str] = None, update_almost_complete_msg: Optional[str] = None, prefetch: bool = False, prefetch_rate: Optional[int] = None, *args, **kwargs):
         """ class constructor.
 
         It accepts all parameters required by :py:class:`updater.core.UpdaterCore`, plus the following:
@@ -77,6 +88,10 @@ class WXUpdater(core.UpdaterCore):
         :type update_almost_complete_title: str
         :param update_almost_complete_msg: Message to explain to users about the application restart, after updates are applied.
         :type update_almost_complete_msg: str
+        :param prefetch: If True, updates are downloaded and extracted silently in a background thread, and users are asked to install them only once they are ready. No progress dialog is displayed in this mode.
+        :type prefetch: bool
+        :param prefetch_rate: Maximum download speed, in bytes per second, when prefetching updates.
+        :type prefetch_rate: int
         :raises: :py:exc:`ModuleNotFoundError` if wx is not present.
         """
         super(WXUpdater, self).__init__(*args, **kwargs)
@@ -94,7 +109,10 @@ class WXUpdater(core.UpdaterCore):
             self.update_almost_complete_title = update_almost_complete_title
         if update_almost_complete_msg:
             self.update_almost_complete_msg = update_almost_complete_msg
+        self.prefetch = prefetch
+        self.prefetch_rate = prefetch_rate
         self.progress_dialog: Any = None
+        self.prefetch_thread: Optional[threading.Thread] = None
 
     def initialize(self) -> None:
         """ Inits pubsub events for the updater, subscribing to the 'updater.update-progress' message. """
@@ -130,6 +148,8 @@ class WXUpdater(core.UpdaterCore):
             self.progress_dialog.Show()
         if total_downloaded == total_size:
             self.progress_dialog.Destroy()
+            # Updates made of several packages display a new dialog for every download.
+            self.progress_dialog = None
         else:
             self.progress_dialog.Update(int((total_downloaded*100)/total_size), self.update_progress_msg.format(total_downloaded=utils.convert_bytes(total_downloaded), total_size=utils.convert_bytes(total_size)))
             self.progress_dialog.SetTitle(self.update_progress_msg.format(total_downloaded=utils.convert_bytes(total_downloaded), total_size=utils.convert_bytes(total_size)))
@@ -142,7 +162,7 @@ class WXUpdater(core.UpdaterCore):
         ms = wx.MessageDialog(None, self.update_almost_complete_msg, self.update_almost_complete_title)
         return ms.ShowModal()
 
-    def check_for_updates(self) -> None:
+    def check_for_updates(self, force: bool = False) -> None:
         """ Check for updates.
 
         This is the only function that should be executed from this class from outside of the updater package.
@@ -150,26 +170,62 @@ class WXUpdater(core.UpdaterCore):
         It checks for updates based in the parameters passed during instantiation.
 
         If there are updates available, displays a dialog to confirm the download of update. If the update downloads successfully, it also extracts and installs it.
+
+        :param force: If True, ignores any update information cached from a previous check. See :py:func:`updater.core.UpdaterCore.get_update_information`.
+        :type force: bool
         """
-        self.initialize()
-        update_info = self.get_update_information()
+        if self.prefetch == False:
+            self.initialize()
+        update_info = self.get_update_information(force=force)
         version_data = self.get_version_data(update_info)
         if version_data[0] == False:
             return None
         self.update_version = version_data[0]
         self.update_description = version_data[1]
+        update_path = self.get_update_path(update_info)
+        if self.prefetch:
+            if self.prefetch_thread != None and self.prefetch_thread.is_alive():
+                # Both threads would stage the update into the same directory.
+                log.debug("Update is already being prefetched")
+                return None
+            self.prefetch_thread = threading.Thread(target=self.prefetch_update, args=(update_path,), daemon=True)
+            self.prefetch_thread.start()
+            return None
         response = self.on_new_update_available()
         if response == False:
             return None
         base_path = tempfile.mkdtemp()
-        download_path = os.path.join(base_path, 'update.zip')
-        downloaded = self.download_update(cast(str, version_data[2]), download_path)
-        update_path = os.path.join(base_path, 'update')
-        extraction_path = self.extract_update(downloaded, destination=update_path)
+        extraction_path = self.download_update_path(update_path, base_path, reference_path=self.get_app_path())
+        self.install_update(extraction_path)
+
+    def prefetch_update(self, update_path: List[Dict[str, Any]]) -> None:
+        """ Stages the update in the background and, once it is ready, asks the user to install it from the main thread.
+
+        This function runs in the thread started by :py:func:`check_for_updates` when :py:attr:`prefetch` is enabled. Errors are logged, so the update can be staged again on the next check.
+        """
+        try:
+            extraction_path = self.stage_update(update_path, cast(str, self.update_version), max_rate=self.prefetch_rate, reference_path=self.get_app_path())
+        except Exception:
+            log.exception("Error while prefetching update")
+            return None
+        wx.CallAfter(self.on_update_staged, extraction_path)
+
+    def on_update_staged(self, extraction_path: str) -> None:
+        """ Asks the user to install an update that has already been downloaded and extracted by :py:func:`prefetch_update`. """
+        response = self.on_new_update_available()
+        if response == False:
+            return None
+        self.install_update(extraction_path)
+
+    def install_update(self, extraction_path: str) -> None:
+        """ Moves the bootstrapper out of the extracted update, informs the user about the restart and runs the bootstrapper.
+
+        :param extraction_path: Path where the update has been extracted.
+        :type extraction_path: str
+        """
         bootstrap_exe = self.move_bootstrap(extraction_path)
-        source_path = paths.app_path()
         self.on_update_almost_complete()
-        self.execute_bootstrap(bootstrap_exe, source_path)
+        self.execute_bootstrap(bootstrap_exe, extraction_path)
 
     def __del__(self) -> None:
         """ Unsubscribe events before deleting this object. """